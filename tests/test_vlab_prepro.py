@@ -1,14 +1,35 @@
 import json
 import math
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import pytest
-
-from vlab_prepro import PreprocessingError, Preprocessor, compute_seed, parse_number
-from vlab_prepro.preprocess import add_final_answer, flatten_dict, wrap_empty
+from toolz import pipe
+
+from vlab_prepro import (
+    Frame,
+    PivotConflictError,
+    PreprocessingError,
+    Preprocessor,
+    StatelessPreprocessor,
+    cli,
+    compute_seed,
+    parse_number,
+)
+from vlab_prepro.preprocess import (
+    GROUP_ID,
+    add_final_answer,
+    answer_time_stats,
+    flatten_dict,
+    merge_answer_times,
+    wrap_empty,
+)
+from vlab_prepro.sketch import AnswerTimes, QuantileSketch
 
 
 def ts(h, m, s):
@@ -716,3 +737,1112 @@ def test_curried_usage_of_add_metadata(df):
     result = step(df)
     assert "stratumid" in result.columns
     assert "stratumid" in p.keys
+
+
+# ---------------------------------------------------------------------------
+# add_respondent_features
+# ---------------------------------------------------------------------------
+
+
+def _canonical(d):
+    cols = ["userid", "surveyid", "timestamp", "question_ref", "response"]
+    return d.sort_values(cols).reset_index(drop=True)
+
+
+def test_add_respondent_features_matches_individual_steps(df, form_df):
+    p = Preprocessor()
+    expected = p.add_form_data(form_df, df)
+    expected = p.add_duration(expected)
+    expected = p.add_final_answer(expected)
+    expected = p.count_invalid(expected)
+
+    fused = Preprocessor()
+    d = fused.add_form_data(form_df, df)
+    d = fused.add_respondent_features(["final_answer", "duration", "invalid"], d)
+
+    assert fused.keys == p.keys
+    pd.testing.assert_frame_equal(
+        _canonical(d)[expected.columns], _canonical(expected)
+    )
+
+
+def test_add_respondent_features_only_computes_requested_features(df):
+    p = Preprocessor()
+    d = p.add_respondent_features(["duration"], df)
+    assert "survey_duration" in d.columns
+    assert "final_answer" not in d.columns
+    assert "invalid_answer_count" not in p.keys
+
+
+def test_add_respondent_features_raises_on_unknown_feature(df):
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError):
+        p.add_respondent_features(["speed"], df)
+
+
+# ---------------------------------------------------------------------------
+# sortedness tracking
+# ---------------------------------------------------------------------------
+
+
+def test_add_final_answer_keeps_row_order(df):
+    d = add_final_answer(df)
+    pd.testing.assert_frame_equal(d.drop(columns="final_answer"), df)
+
+
+def test_add_duration_records_grouping_and_skips_resort(df):
+    p = Preprocessor()
+    d = p.add_duration(df)
+    assert p.grouped_by == {"userid"}
+
+    again = p.add_duration(d)
+    pd.testing.assert_frame_equal(again, d)
+
+
+def test_add_duration_resorts_if_frame_is_not_in_tracked_order(df):
+    p = Preprocessor()
+    d = p.add_duration(df)
+    shuffled = d.sample(frac=1, random_state=1).reset_index(drop=True)
+
+    again = p.add_duration(shuffled)
+    assert not again.equals(shuffled)
+    pd.testing.assert_frame_equal(_canonical(again), _canonical(d))
+
+
+def test_pivot_output_sorted_by_userid(df, form_df):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.keep_final_answer(d)
+    d = p.pivot("response", d)
+    assert d.userid.is_monotonic_increasing
+
+
+# ---------------------------------------------------------------------------
+# group ids
+# ---------------------------------------------------------------------------
+
+
+def test_steps_do_not_output_group_id(df, form_df):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.add_duration(d)
+    d = p.remove_form_data(d)
+    assert GROUP_ID not in d.columns
+
+
+def test_group_id_follows_keys_added_in_place(df):
+    p = Preprocessor()
+    d = p.add_duration(df)
+    d["stratumid"] = ["Z"] * 7 + ["Y"] + ["Z"] * 4
+    p.keys.add("stratumid")
+    d = p.add_duration(d)
+    assert d.groupby(["userid", "stratumid"]).survey_duration.nunique().eq(1).all()
+    assert d[d.stratumid == "Y"].survey_duration.iloc[0] == 0
+
+
+def test_pivot_does_not_output_group_id(df, form_df):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.keep_final_answer(d)
+    d = p.pivot("response", d)
+    assert GROUP_ID not in d.columns
+    assert d.shape[0] == 6
+
+
+def test_group_id_leaves_user_columns_alone(df):
+    p = Preprocessor()
+    d = p.add_duration(df.assign(group_id=1))
+    assert (d.group_id == 1).all()
+
+
+def test_output_of_one_preprocessor_runs_through_another(df):
+    d = Preprocessor().add_duration(df)
+    d = Preprocessor().add_duration(d)
+    assert d.shape[0] == df.shape[0]
+
+
+def test_pivot_of_concatenated_chunks_keeps_users_apart(form_df):
+    a = make_df(
+        [
+            ("a", "1", 1, "A", 1, "r1", ts(12, 2, 0), "{}"),
+            ("a", "1", 1, "B", 2, "r1", ts(12, 2, 1), "{}"),
+        ]
+    )
+    b = make_df([("a", "2", 1, "A", 1, "r2", ts(12, 3, 0), "{}")])
+
+    p1, p2 = Preprocessor(), Preprocessor()
+    chunks = [p1.add_form_data(form_df, a), p2.add_form_data(form_df, b)]
+    d = p1.pivot("response", pd.concat(chunks, ignore_index=True))
+
+    assert d.userid.tolist() == ["1", "2"]
+    assert d.A.tolist() == ["r1", "r2"]
+    assert d.B.isna().tolist() == [False, True]
+
+
+def test_preprocessor_can_be_reused_on_another_export(df, form_df):
+    p = Preprocessor()
+    p.add_form_data(form_df, df)
+    d = p.add_form_data(form_df, df[df.surveyid == "a"])
+    assert set(d.surveyid) == {"a"}
+
+
+def test_replacing_a_key_column_recomputes_group_id(form_df):
+    df = make_df(
+        [
+            ("a", "1", 1, "A", 1, "r", ts(12, 2, 0), '{"wave": "1"}'),
+            ("a", "1", 1, "B", 2, "r", ts(12, 2, 1), '{"wave": "1"}'),
+            ("a", "1", 1, "A", 1, "r", ts(12, 3, 0), '{"wave": "2"}'),
+            ("a", "1", 1, "B", 2, "r", ts(12, 3, 1), '{"wave": "2"}'),
+        ]
+    )
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.add_metadata(["wave"], d)
+    d = p.pivot("response", d)
+    assert d.wave.tolist() == ["1", "2"]
+
+
+# ---------------------------------------------------------------------------
+# pivot_to_parquet
+# ---------------------------------------------------------------------------
+
+
+def test_pivot_to_parquet_writes_one_partition_per_survey(df, form_df, tmp_path):
+    pytest.importorskip("pyarrow")
+
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.keep_final_answer(d)
+    paths = p.pivot_to_parquet("response", tmp_path, d)
+
+    assert sorted(path.parent.name for path in paths) == [
+        "surveyid=a",
+        "surveyid=b",
+        "surveyid=c",
+    ]
+
+    b = pd.read_parquet(tmp_path / "surveyid=b" / "part-0.parquet")
+    assert set(b.userid) == {"1", "3"}
+    assert "A" in b.columns and "B" in b.columns
+    # every file has every question, so the directory reads back whole
+    assert b.C.isna().all() and b.D.isna().all()
+
+
+def test_pivot_to_parquet_matches_pivot_when_bucketed_by_user(df, form_df, tmp_path):
+    pytest.importorskip("pyarrow")
+
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.keep_final_answer(d)
+    paths = p.pivot_to_parquet("response", tmp_path, d, buckets=2)
+
+    written = pd.concat([pd.read_parquet(path) for path in paths])
+    expected = p.pivot("response", d)
+    assert written.shape[0] == expected.shape[0]
+    assert set(zip(written.userid, written.surveyid)) == set(
+        zip(expected.userid, expected.surveyid)
+    )
+
+
+def test_pivot_to_parquet_output_reads_back_as_the_pivot(df, form_df, tmp_path):
+    pytest.importorskip("pyarrow")
+
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.keep_final_answer(d)
+    p.pivot_to_parquet("response", tmp_path, d)
+
+    written = pd.read_parquet(tmp_path)
+    expected = p.pivot("response", d)
+    written = written.assign(surveyid=written.surveyid.astype(str))[expected.columns]
+
+    def normalize(f):
+        f = f.sort_values(["surveyid", "userid"]).reset_index(drop=True)
+        return f.astype(object).where(f.notna(), None)
+
+    pd.testing.assert_frame_equal(
+        normalize(written), normalize(expected), check_names=False
+    )
+
+
+def test_pivot_to_parquet_escapes_partition_values(df, form_df, tmp_path):
+    pytest.importorskip("pyarrow")
+
+    df = df.assign(surveyid=df.surveyid.replace({"a": "a/x"}))
+    form_df = form_df.assign(surveyid=form_df.surveyid.replace({"a": "a/x"}))
+
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.keep_final_answer(d)
+    paths = p.pivot_to_parquet("response", tmp_path, d)
+
+    assert all(path.parent.parent == tmp_path for path in paths)
+    written = pd.read_parquet(tmp_path)
+    assert set(written.surveyid.astype(str)) == {"a/x", "b", "c"}
+
+
+def test_pivot_to_parquet_raises_if_partition_is_not_a_key(df, tmp_path):
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError):
+        p.pivot_to_parquet("response", tmp_path, df, partition_by="shortcode")
+
+
+# ---------------------------------------------------------------------------
+# sample_users
+# ---------------------------------------------------------------------------
+
+
+@pytest.fixture
+def many_users_df():
+    data = [
+        (s, str(u), 1, q, i, "response", ts(12, 0, i), "{}")
+        for u in range(200)
+        for s in ["a", "b"]
+        for i, q in enumerate(["A", "B"])
+        if not (s == "b" and u >= 10)
+    ]
+    return make_df(data)
+
+
+def test_sample_users_is_deterministic_and_keeps_all_user_rows(many_users_df):
+    p = Preprocessor()
+    d1 = p.sample_users(0.2, many_users_df)
+    d2 = p.sample_users(0.2, many_users_df)
+    pd.testing.assert_frame_equal(d1, d2)
+
+    assert 10 < d1.userid.nunique() < 70
+    sizes = many_users_df.groupby("userid").size()
+    kept = d1.groupby("userid").size()
+    assert (kept == sizes[kept.index]).all()
+
+
+def test_sample_users_depends_on_seed(many_users_df):
+    p = Preprocessor()
+    d1 = p.sample_users(0.2, many_users_df, seed=1)
+    d2 = p.sample_users(0.2, many_users_df, seed=2)
+    assert set(d1.userid) != set(d2.userid)
+
+
+def test_sample_users_is_stable_as_users_are_added(many_users_df):
+    p = Preprocessor()
+    subset = many_users_df[many_users_df.userid.astype(int) < 100]
+    small = p.sample_users(0.2, subset)
+    large = p.sample_users(0.2, many_users_df)
+    assert set(small.userid) == set(large[large.userid.astype(int) < 100].userid)
+
+
+def test_sample_users_stratified_keeps_users_from_each_stratum(many_users_df):
+    p = Preprocessor()
+    d = p.sample_users(0.05, many_users_df, by=["surveyid"])
+    assert set(d.surveyid) == {"a", "b"}
+    assert d[d.surveyid == "a"].userid.nunique() >= 10
+
+
+def test_sample_users_raises_on_bad_fraction_or_missing_column(many_users_df):
+    p = Preprocessor()
+    with pytest.raises(ValueError):
+        p.sample_users(0, many_users_df)
+    with pytest.raises(PreprocessingError):
+        p.sample_users(0.5, many_users_df, by=["wave"])
+
+
+# ---------------------------------------------------------------------------
+# pivot conflicts
+# ---------------------------------------------------------------------------
+
+
+def test_pivot_conflicts_reports_duplicated_questions(df, form_df):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    report = p.pivot_conflicts(d)
+
+    assert report.shape[0] == 1
+    line = report.iloc[0]
+    assert (line.userid, line.surveyid, line.question_ref) == ("3", "b", "A")
+    assert line.answers == 2
+
+
+def test_pivot_raises_conflict_error_with_report(df, form_df):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+
+    with pytest.raises(PivotConflictError) as e:
+        p.pivot("response", d)
+
+    assert isinstance(e.value, PreprocessingError)
+    assert list(e.value.report.userid) == ["3"]
+
+
+def test_pivot_can_keep_final_answer_on_conflict(df, form_df):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    resolved = p.pivot("response", d, on_conflict="final")
+    expected = p.pivot("response", p.keep_final_answer(d))
+    pd.testing.assert_frame_equal(resolved, expected)
+
+
+# ---------------------------------------------------------------------------
+# respondent table
+# ---------------------------------------------------------------------------
+
+
+def _respondent_pipeline(p, df, form_df):
+    d = p.add_form_data(form_df, df)
+    d = p.add_duration(d)
+    d = p.add_time_indicators(["week"], d)
+    d = p.count_invalid(d)
+    d = p.keep_final_answer(d)
+    return d
+
+
+def test_respondent_table_keeps_features_off_the_responses(df, form_df):
+    p = Preprocessor(respondent_table=True)
+    d = _respondent_pipeline(p, df, form_df)
+
+    for col in ["survey_duration", "week", "invalid_answer_count"]:
+        assert col not in d.columns
+        assert col not in p.keys
+        assert col in p.respondents.columns
+
+    assert p.respondents.shape[0] == 6
+
+
+def test_respondent_table_pivot_matches_broadcast_features(df, form_df):
+    p = Preprocessor()
+    d = _respondent_pipeline(p, df, form_df)
+    expected = p.pivot("response", d)
+
+    t = Preprocessor(respondent_table=True)
+    d = _respondent_pipeline(t, df, form_df)
+    result = t.pivot("response", d)
+
+    cols = ["userid", "surveyid"]
+    expected = expected.sort_values(cols).reset_index(drop=True)
+    result = result.sort_values(cols).reset_index(drop=True)[expected.columns]
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+
+def test_respondent_table_follows_hash_userid(df, form_df):
+    p = Preprocessor(respondent_table=True)
+    d = p.add_form_data(form_df, df)
+    d = p.count_invalid(d)
+    d = p.keep_final_answer(d)
+    d = p.hash_userid(d)
+    result = p.pivot("response", d)
+    assert result.invalid_answer_count.notna().all()
+
+
+# ---------------------------------------------------------------------------
+# batch runner
+# ---------------------------------------------------------------------------
+
+
+@pytest.fixture
+def spec(df, form_df, tmp_path):
+    studies = []
+    for name in ["one", "two"]:
+        df.to_csv(tmp_path / f"{name}.csv", index=False)
+        form_df.to_csv(tmp_path / f"{name}_forms.csv", index=False)
+        studies.append(
+            {
+                "name": name,
+                "responses": str(tmp_path / f"{name}.csv"),
+                "forms": str(tmp_path / f"{name}_forms.csv"),
+            }
+        )
+
+    return {
+        "pipeline": [
+            "add_form_data",
+            {"step": "add_metadata", "args": [["stratumid"]]},
+            "add_duration",
+            "keep_final_answer",
+            {"step": "pivot", "args": ["response"]},
+        ],
+        "studies": studies,
+    }
+
+
+def test_run_study_writes_output_and_summarizes(spec, tmp_path):
+    summary = cli.run_study(spec, spec["studies"][0], tmp_path / "out")
+
+    assert summary["status"] == "ok"
+    assert summary["input_rows"] == 12
+    assert summary["output_rows"] == 6
+    assert [s["step"] for s in summary["steps"]][-1] == "pivot"
+
+    written = pd.read_csv(summary["output"])
+    assert written.shape[0] == 6
+
+
+def test_run_study_does_not_write_group_id(spec, tmp_path):
+    spec["pipeline"] = spec["pipeline"][:3]
+    summary = cli.run_study(spec, spec["studies"][0], tmp_path / "out")
+    assert GROUP_ID not in pd.read_csv(summary["output"]).columns
+
+
+def test_run_study_reports_failures(spec, tmp_path):
+    spec["pipeline"] = ["add_duration", {"step": "pivot", "args": ["response"]}]
+    summary = cli.run_study(spec, spec["studies"][0], tmp_path / "out")
+    assert summary["status"] == "failed"
+    assert "PivotConflictError" in summary["error"]
+
+
+def test_validate_spec_rejects_unknown_steps(spec):
+    spec["pipeline"].append("not_a_step")
+    with pytest.raises(PreprocessingError):
+        cli.validate_spec(spec)
+
+
+def test_main_runs_all_studies(spec, tmp_path, capsys):
+    path = tmp_path / "spec.json"
+    path.write_text(json.dumps(spec))
+
+    code = cli.main([str(path), str(tmp_path / "out"), "--workers", "2"])
+
+    assert code == 0
+    lines = capsys.readouterr().out.strip().split("\n")
+    summaries = [json.loads(line) for line in lines]
+    assert sorted(s["study"] for s in summaries) == ["one", "two"]
+    assert (tmp_path / "out" / "two.csv").exists()
+
+
+# ---------------------------------------------------------------------------
+# stateless preprocessing
+# ---------------------------------------------------------------------------
+
+
+def test_stateless_steps_carry_keys_with_the_frame(df, form_df):
+    p = StatelessPreprocessor()
+    start = Frame(df)
+    with_forms = p.add_form_data(form_df, start)
+
+    assert "surveyid" in with_forms.keys
+    assert start.keys == {"userid"}
+
+    with_metadata = p.add_metadata(["stratumid"])(with_forms)
+    assert "stratumid" in with_metadata.keys
+    assert "stratumid" not in with_forms.keys
+
+
+def test_stateless_pipeline_matches_preprocessor(df, form_df):
+    p = Preprocessor()
+    expected = pipe(
+        df,
+        p.add_form_data(form_df),
+        p.add_duration,
+        p.count_invalid,
+        p.keep_final_answer,
+        p.pivot("response"),
+    )
+
+    s = StatelessPreprocessor()
+    result = pipe(
+        Frame(df),
+        s.add_form_data(form_df),
+        s.add_duration,
+        s.count_invalid,
+        s.keep_final_answer,
+        s.pivot("response"),
+    )
+
+    pd.testing.assert_frame_equal(result.df, expected)
+
+
+def test_stateless_pipelines_run_concurrently(df, form_df):
+    s = StatelessPreprocessor(respondent_table=True)
+
+    def run(i):
+        d = df.assign(userid=df.userid + f"-{i}")
+        return pipe(
+            Frame(d),
+            s.add_form_data(form_df),
+            s.add_duration,
+            s.keep_final_answer,
+            s.pivot("response"),
+        )
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(run, range(8)))
+
+    for i, result in enumerate(results):
+        assert result.df.userid.str.endswith(f"-{i}").all()
+        assert result.df.survey_duration.notna().all()
+
+
+def test_stateless_steps_reject_plain_dataframes(df, form_df):
+    s = StatelessPreprocessor()
+    with pytest.raises(TypeError):
+        s.add_metadata(["stratumid"], df)
+    with pytest.raises(TypeError):
+        s.add_duration(df)
+
+    # dataframes given as arguments, rather than as the df, are fine
+    result = s.add_form_data(form_df)(Frame(df))
+    assert "shortcode" in result.df.columns
+
+
+def test_stateless_preprocessor_has_no_private_steps():
+    s = StatelessPreprocessor()
+    with pytest.raises(AttributeError):
+        s._pivot
+
+
+# ---------------------------------------------------------------------------
+# add_question_timing
+# ---------------------------------------------------------------------------
+
+
+def test_add_question_timing_adds_time_since_previous_answer(df):
+    p = Preprocessor()
+    d = p.add_question_timing(df)
+
+    u1 = d[(d.userid == "1") & (d.surveyid == "a")].set_index("question_ref")
+    assert math.isnan(u1.question_time["A"])
+    assert u1.question_time["B"] == 1.0
+    assert u1.question_time["C"] == 4.0
+    assert u1.question_time["D"] == 5.0
+
+    # the first answer in a second survey starts over
+    u1b = d[(d.userid == "1") & (d.surveyid == "b")].set_index("question_ref")
+    assert math.isnan(u1b.question_time["A"])
+
+
+def test_add_question_timing_adds_median_and_speeding_flags(df):
+    p = Preprocessor()
+    d = p.add_question_timing(df, speeding_threshold=0.5)
+
+    # survey a, question B: user 1 took 1 second, user 2 took 5 seconds
+    b = d[(d.surveyid == "a") & (d.question_ref == "B")].set_index("userid")
+    assert (b.question_time_median == 3.0).all()
+    assert b.question_speeding["1"]
+    assert not b.question_speeding["2"]
+    assert not d[d.question_time.isna()].question_speeding.any()
+
+
+def test_add_question_timing_can_be_pivoted(df, form_df):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.keep_final_answer(d)
+    d = p.add_question_timing(d)
+    assert "question_time" not in p.keys
+
+    pivoted = p.pivot("question_time", d)
+    row = pivoted[(pivoted.userid == "1") & (pivoted.surveyid == "a")].iloc[0]
+    assert row["D"] == 5.0
+
+
+# ---------------------------------------------------------------------------
+# dedupe_events
+# ---------------------------------------------------------------------------
+
+
+def test_dedupe_events_removes_exact_duplicates(df, caplog):
+    doubled = pd.concat([df, df.iloc[[0, 5]]]).reset_index(drop=True)
+    p = Preprocessor()
+    d = p.dedupe_events(doubled)
+
+    pd.testing.assert_frame_equal(d, df)
+    assert "Removing 2 duplicated events" in caplog.text
+
+
+def test_dedupe_events_keeps_same_event_at_different_times(df):
+    p = Preprocessor()
+    d = p.dedupe_events(df, columns=["userid", "surveyid", "question_ref"])
+    assert d.shape[0] == df.shape[0]
+
+
+def test_dedupe_events_removes_events_within_tolerance(df):
+    retry = df.iloc[[0]].assign(timestamp=ts(12, 2, 3))
+    late = df.iloc[[0]].assign(timestamp=ts(12, 5, 0))
+    data = pd.concat([df, retry, late]).reset_index(drop=True)
+
+    p = Preprocessor()
+    d = p.dedupe_events(data, tolerance="5s")
+    assert d.shape[0] == df.shape[0] + 1
+
+    d = p.dedupe_events(data, tolerance=10)
+    assert d.shape[0] == df.shape[0] + 1
+
+
+def test_dedupe_events_compares_to_the_last_kept_event(df):
+    retries = [df.iloc[[0]].assign(timestamp=ts(12, 2, s)) for s in [4, 8, 9, 14]]
+    data = pd.concat([df, *retries]).reset_index(drop=True)
+
+    p = Preprocessor()
+    d = p.dedupe_events(data, tolerance=5)
+
+    # 0s is kept, 4s is within 5s of it, 8s is not, 9s is within 5s of 8s
+    # and 14s is not
+    kept = d[(d.userid == "1") & (d.question_ref == "A") & (d.surveyid == "a")]
+    assert kept.timestamp.tolist() == [dt(12, 2, 0), dt(12, 2, 8), dt(12, 2, 14)]
+
+
+def test_dedupe_events_only_fingerprints_given_columns(df):
+    p = Preprocessor()
+    cols = ["surveyid", "userid", "question_ref"]
+    d = p.dedupe_events(df, columns=cols, tolerance="1s")
+
+    # user 3 answered question A in survey b twice, a second apart
+    assert d[(d.userid == "3") & (d.surveyid == "b")].shape[0] == 1
+    assert d.response[d.userid == "3"].tolist() == ["response", "response"]
+
+
+# ---------------------------------------------------------------------------
+# add_form_data lookup
+# ---------------------------------------------------------------------------
+
+
+def test_add_form_data_matches_merge_and_leaves_responses_untouched(df, form_df):
+    original = df.copy()
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+
+    expected = df.merge(flatten_dict("metadata", form_df), on="surveyid")
+    pd.testing.assert_frame_equal(d, expected)
+    pd.testing.assert_frame_equal(df, original)
+
+
+def test_add_form_data_drops_responses_without_form(df, form_df, caplog):
+    p = Preprocessor()
+    d = p.add_form_data(form_df[form_df.surveyid != "c"], df)
+    assert set(d.surveyid) == {"a", "b"}
+    assert d.index.equals(pd.RangeIndex(d.shape[0]))
+    assert "Removing 2 responses" in caplog.text
+
+
+def test_add_form_data_raises_when_no_surveyids_match(df, form_df):
+    df = df.assign(surveyid=df.surveyid.map({"a": 1, "b": 2, "c": 3}))
+    form_df = form_df.assign(surveyid=["1", "2", "3"])
+
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError, match="same type"):
+        p.add_form_data(form_df, df)
+
+
+def test_add_form_data_raises_on_columns_already_in_responses(df, form_df):
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError, match="flowid"):
+        p.add_form_data(form_df.assign(flowid=1), df)
+
+
+def test_add_form_data_raises_on_duplicated_surveys(df, form_df):
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError):
+        p.add_form_data(pd.concat([form_df, form_df]), df)
+
+
+def test_flatten_dict_keys_override_existing_columns():
+    data = pd.DataFrame({
+        "wave": ["old", "old"],
+        "meta": ['{"wave": "1"}', '{}'],
+    })
+    result = flatten_dict("meta", data)
+    assert result.wave.tolist() == ["1", "old"]
+
+
+# ---------------------------------------------------------------------------
+# add_waves
+# ---------------------------------------------------------------------------
+
+
+@pytest.fixture
+def wave_table():
+    # forms already have a "wave" in their metadata
+    return pd.DataFrame(
+        {
+            "panel_wave": ["w1", "w2"],
+            "start": ["2020-01-01T12:02:00Z", "2020-01-01T12:03:00Z"],
+            "end": ["2020-01-01T12:02:30Z", None],
+        }
+    )
+
+
+def test_add_waves_labels_surveys_by_start_time(df, form_df, wave_table):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.add_duration(d)
+    d = p.add_waves(wave_table, d, name="panel_wave")
+
+    waves = d.groupby(["userid", "surveyid"]).panel_wave.first()
+    assert waves[("1", "a")] == "w1"
+    assert waves[("1", "b")] == "w2"
+    assert waves[("2", "c")] == "w2"
+    assert "panel_wave" in p.keys
+
+
+def test_add_waves_leaves_gaps_between_waves_empty(df, wave_table):
+    p = Preprocessor()
+    d = p.add_duration(df)
+    wave_table["start"] = ["2020-01-01T12:02:10Z", "2020-01-01T12:03:00Z"]
+    d = p.add_waves(wave_table, d, name="panel_wave")
+    assert d.panel_wave.isna().all()
+
+
+def test_add_waves_can_drop_duplicated_users(df, form_df, wave_table):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.add_duration(d)
+    d = p.add_waves(wave_table, d, name="panel_wave")
+    d = p.drop_duplicated_users(["panel_wave"], d)
+    assert "2" in d.userid.unique()
+
+
+def test_add_waves_from_respondent_table(df, form_df, wave_table):
+    p = Preprocessor(respondent_table=True)
+    d = p.add_form_data(form_df, df)
+    d = p.add_duration(d)
+    d = p.add_waves(wave_table, d, name="panel_wave")
+    assert d[(d.userid == "1") & (d.surveyid == "b")].panel_wave.eq("w2").all()
+    assert "panel_wave" in p.respondents.columns
+
+
+def test_add_waves_raises_on_overlapping_waves(df, wave_table):
+    p = Preprocessor()
+    d = p.add_duration(df)
+    wave_table["end"] = ["2020-01-01T12:04:00Z", None]
+    with pytest.raises(PreprocessingError):
+        p.add_waves(wave_table, d, name="panel_wave")
+
+
+def test_add_waves_raises_on_open_ended_waves_before_the_last(df, wave_table):
+    p = Preprocessor()
+    d = p.add_duration(df)
+    wave_table["end"] = [None, None]
+    with pytest.raises(PreprocessingError):
+        p.add_waves(wave_table, d, name="panel_wave")
+
+
+def test_add_waves_raises_on_empty_wave_table(df, wave_table):
+    p = Preprocessor()
+    d = p.add_duration(df)
+    with pytest.raises(PreprocessingError):
+        p.add_waves(wave_table.iloc[:0], d, name="panel_wave")
+
+
+def test_add_waves_keeps_integer_wave_ids(df, form_df, wave_table):
+    p = Preprocessor()
+    d = p.add_form_data(form_df, df)
+    d = p.add_duration(d)
+    d = p.add_waves(wave_table.assign(panel_wave=[1, 2]), d, name="panel_wave")
+    assert pd.api.types.is_integer_dtype(d.panel_wave)
+    assert set(d.panel_wave) == {1, 2}
+
+    # with responses outside of every wave, the ids are nullable integers
+    wave_table["start"] = ["2020-01-01T12:02:10Z", "2020-01-01T12:03:00Z"]
+    d = p.add_waves(wave_table.assign(panel_wave=[1, 2]), d, name="panel_wave")
+    assert d.panel_wave.dtype == "Int64"
+    assert set(d.panel_wave.dropna()) == {2}
+    assert d.panel_wave.isna().any()
+
+
+def test_add_waves_requires_start_time(df, wave_table):
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError):
+        p.add_waves(wave_table, df, name="panel_wave")
+
+
+# ---------------------------------------------------------------------------
+# answer time sketches
+# ---------------------------------------------------------------------------
+
+
+def test_quantile_sketch_is_within_relative_accuracy():
+    values = np.random.default_rng(1).lognormal(3, 1.5, 10001)
+    sketch = QuantileSketch(0.01).add(values)
+
+    for q in [0.1, 0.5, 0.75, 0.9, 0.99]:
+        exact = np.quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+
+    assert sketch.min == values.min()
+    assert sketch.quantile(1) == values.max()
+
+
+def test_quantile_sketch_merge_equals_sketch_of_all_values():
+    values = np.random.default_rng(2).exponential(10, 1000)
+    values[:10] = 0.0
+    whole = QuantileSketch(0.02).add(values)
+    merged = QuantileSketch(0.02).add(values[:300]).merge(
+        QuantileSketch(0.02).add(values[300:])
+    )
+    assert merged.to_dict() == whole.to_dict()
+
+
+def test_answer_times_serialize_and_merge_gap_between_chunks():
+    first = AnswerTimes(QuantileSketch().add([1, 4]), dt(12, 0, 0), dt(12, 0, 5))
+    second = AnswerTimes(QuantileSketch().add([2]), dt(12, 0, 8), dt(12, 0, 10))
+
+    restored = AnswerTimes.from_dict(json.loads(json.dumps(second.to_dict())))
+    merged = restored.merge(first)
+
+    assert merged.start == dt(12, 0, 0)
+    assert merged.end == dt(12, 0, 10)
+    # the gap of 3 seconds between the chunks is counted too
+    assert merged.sketch.count == 4
+    assert merged.sketch.min == 1.0
+    assert abs(merged.sketch.quantile(0.5) - 2.5) <= 0.025
+
+
+def test_add_duration_with_sketches_approximates_exact_stats(df):
+    exact = Preprocessor().add_duration(df)
+    p = Preprocessor()
+    d = p.add_duration(df, relative_accuracy=0.01)
+
+    assert p.answer_times.shape[0] == 3
+    pd.testing.assert_series_equal(d.survey_duration, exact.survey_duration)
+    pd.testing.assert_series_equal(d.answer_time_min, exact.answer_time_min)
+
+    for col in ["answer_time_median", "answer_time_75", "answer_time_90"]:
+        assert np.allclose(d[col], exact[col], rtol=0.01, equal_nan=True)
+
+
+def test_sketch_quantiles_interpolate_like_add_duration():
+    df = make_df(
+        [
+            ("a", "1", 1, "A", 1, "r", ts(12, 2, 0), "{}"),
+            ("a", "1", 1, "B", 2, "r", ts(12, 2, 1), "{}"),
+            ("a", "1", 1, "C", 3, "r", ts(12, 3, 41), "{}"),
+        ]
+    )
+    exact = Preprocessor().add_duration(df).iloc[0]
+    sketched = Preprocessor().add_duration(df, relative_accuracy=0.01).iloc[0]
+
+    # gaps of 1 and 100 seconds: 50.5, 75.25 and 90.1
+    for col in ["answer_time_median", "answer_time_75", "answer_time_90"]:
+        assert abs(sketched[col] - exact[col]) <= 0.01 * exact[col]
+
+
+def test_merge_answer_times_does_not_depend_on_the_order_of_chunks(df):
+    parsed = Preprocessor().parse_timestamp(df)
+    parsed = parsed[parsed.userid == "1"]
+    bounds = [dt(12, 0, 0), dt(12, 2, 3), dt(12, 2, 30), dt(12, 5, 0)]
+
+    tables = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        c = Preprocessor()
+        chunk = parsed[(parsed.timestamp >= start) & (parsed.timestamp < end)]
+        c.add_duration(chunk, relative_accuracy=0.01)
+        tables.append(c.answer_times)
+
+    in_order = merge_answer_times(*tables).answer_times[0]
+    shuffled = merge_answer_times(tables[0], tables[2], tables[1]).answer_times[0]
+    assert shuffled.sketch.to_dict() == in_order.sketch.to_dict()
+    assert in_order.sketch.count == parsed.shape[0] - 1
+
+
+def test_answer_times_of_chunks_merge_despite_derived_keys(df):
+    parsed = Preprocessor().parse_timestamp(df)
+    early = parsed.timestamp < dt(12, 2, 3)
+
+    tables = []
+    for chunk in [parsed[early], parsed[~early]]:
+        c = Preprocessor()
+        d = c.count_invalid(chunk)
+        c.add_duration(d, relative_accuracy=0.01)
+        assert "invalid_answer_count" not in c.answer_times.columns
+        tables.append(c.answer_times)
+
+    merged = merge_answer_times(*tables)
+    assert merged.userid.is_unique
+
+    on_userid = merge_answer_times(*tables, on=["userid"])
+    assert on_userid.columns.tolist() == ["userid", "answer_times"]
+    assert on_userid.shape[0] == 3
+
+
+def test_merged_answer_times_of_chunks_match_single_run(df):
+    p = Preprocessor()
+    whole = p.add_duration(df, relative_accuracy=0.01)
+    expected = p.answer_times
+
+    parsed = Preprocessor().parse_timestamp(df)
+    tables = []
+    early = parsed.timestamp < dt(12, 2, 3)
+    for chunk in [parsed[early], parsed[~early]]:
+        c = Preprocessor()
+        c.add_duration(chunk, relative_accuracy=0.01)
+        tables.append(c.answer_times)
+
+    merged = merge_answer_times(*tables).sort_values("userid").reset_index(drop=True)
+    stats = answer_time_stats(merged)
+
+    for _, row in stats.iterrows():
+        w = whole[whole.userid == row.userid].iloc[0]
+        for col in ["survey_duration", "answer_time_min", "answer_time_median"]:
+            assert row[col] == w[col] or (np.isnan(row[col]) and np.isnan(w[col]))
+
+    assert [a.sketch.count for a in merged.answer_times] == [
+        a.sketch.count for a in expected.sort_values("userid").answer_times
+    ]
+
+
+# ---------------------------------------------------------------------------
+# lazy imports
+# ---------------------------------------------------------------------------
+
+
+def _imported_after(code):
+    out = subprocess.run(
+        [sys.executable, "-c", f"{code}\nimport sys; print(sorted(sys.modules))"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return set(json.loads(out.stdout.replace("'", '"')))
+
+
+def test_compute_seed_imports_without_dataframe_libraries():
+    modules = _imported_after(
+        "import vlab_prepro\n"
+        "vlab_prepro.compute_seed(2960024492, 2)\n"
+        "vlab_prepro.parse_number('1,000')"
+    )
+    for heavy in ["pandas", "numpy", "polars", "toolz", "vlab_prepro.preprocess"]:
+        assert heavy not in modules
+
+
+def test_preprocessor_is_loaded_on_first_use():
+    modules = _imported_after("from vlab_prepro import Preprocessor, Frame")
+    assert "pandas" in modules
+
+    import vlab_prepro
+
+    assert vlab_prepro.Preprocessor is Preprocessor
+    assert "Frame" in dir(vlab_prepro)
+    with pytest.raises(AttributeError):
+        vlab_prepro.not_a_thing
+
+
+# ---------------------------------------------------------------------------
+# completion_funnel
+# ---------------------------------------------------------------------------
+
+
+def test_completion_funnel_counts_reached_and_dropped_off(df):
+    p = Preprocessor()
+    f = p.completion_funnel(df)
+
+    a = f[f.surveyid == "a"].set_index("question_idx")
+    # user 1 reached question 4, user 2 dropped off after question 2
+    assert a.dropped_off.tolist() == [0, 1, 0, 1]
+    assert a.reached.tolist() == [2, 2, 1, 1]
+    assert a.reached_rate.tolist() == [1.0, 1.0, 0.5, 0.5]
+
+    c = f[f.surveyid == "c"].set_index("question_idx")
+    assert c.reached.to_dict() == {1: 2, 2: 1}
+
+
+def test_completion_funnel_by_stratum(df):
+    p = Preprocessor()
+    d = p.add_metadata(["stratumid"], df)
+    f = p.completion_funnel(d, group_by=["stratumid"])
+
+    a = f[f.surveyid == "a"]
+    assert a[a.stratumid == "Z"].reached.tolist() == [1, 1, 1, 1]
+    assert a[a.stratumid == "X"].reached.tolist() == [1, 1, 0, 0]
+    assert a[a.stratumid == "X"].dropped_off.tolist() == [0, 1, 0, 0]
+
+    # users without a stratum get their own funnel
+    c = f[f.surveyid == "c"]
+    assert c[c.stratumid.isna()].reached.tolist() == [1, 1]
+
+
+def test_completion_funnel_matches_loop_over_final_answers(df):
+    p = Preprocessor()
+    d = p.keep_final_answer(df)
+    f = p.completion_funnel(d).set_index(["surveyid", "question_idx"])
+
+    last = d.groupby(["userid", "surveyid"]).question_idx.max()
+    for (survey, idx), row in f.iterrows():
+        survey_last = last[last.index.get_level_values("surveyid") == survey]
+        assert row.reached == (survey_last >= idx).sum()
+        assert row.dropped_off == (survey_last == idx).sum()
+
+
+def test_completion_funnel_raises_on_unknown_keys(df):
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError):
+        p.completion_funnel(df, group_by=["stratumid"])
+
+
+# ---------------------------------------------------------------------------
+# join_panel
+# ---------------------------------------------------------------------------
+
+
+@pytest.fixture
+def waves():
+    w1 = pd.DataFrame({"userid": ["b", "a", "c"], "A": [1, 2, 3], "B": [4, 5, 6]})
+    w2 = pd.DataFrame({"userid": ["d", "b"], "A": [7, 8]})
+    return w1, w2
+
+
+def test_join_panel_aligns_waves_on_userid(waves):
+    p = Preprocessor()
+    panel = p.join_panel(list(waves))
+
+    assert panel.columns.tolist() == ["userid", "w1_A", "w1_B", "w2_A"]
+    assert panel.userid.tolist() == ["a", "b", "c", "d"]
+    assert panel.w1_A.tolist()[:3] == [2, 1, 3]
+    assert np.isnan(panel.w1_A.iloc[3])
+    assert panel.w2_A.tolist()[1] == 8
+    assert panel.w2_A.isna().tolist() == [True, False, True, False]
+
+
+def test_join_panel_matches_chained_merges(waves):
+    p = Preprocessor()
+    panel = p.join_panel(list(waves), labels=["base", "end"], suffix=True)
+
+    w1, w2 = waves
+    expected = (
+        w1.rename(columns=lambda c: c if c == "userid" else f"{c}_base")
+        .merge(w2.rename(columns={"A": "A_end"}), on="userid", how="outer")
+        .sort_values("userid")
+        .reset_index(drop=True)
+    )
+    pd.testing.assert_frame_equal(
+        panel, expected, check_dtype=False, check_names=False
+    )
+
+
+def test_join_panel_inner_keeps_users_in_every_wave(waves):
+    p = Preprocessor()
+    panel = p.join_panel(list(waves), how="inner")
+    assert panel.userid.tolist() == ["b"]
+    assert panel.iloc[0][["w1_A", "w1_B", "w2_A"]].tolist() == [1, 4, 8]
+
+
+def test_join_panel_raises_on_duplicated_users(waves):
+    w1, w2 = waves
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError):
+        p.join_panel([w1, pd.concat([w2, w2])])
+    with pytest.raises(ValueError):
+        p.join_panel([w1, w2], labels=["x", "x"])
+
+
+def test_join_panel_raises_on_missing_users(waves):
+    w1, w2 = waves
+    w1 = pd.concat([w1, pd.DataFrame({"userid": [None], "A": [9], "B": [9]})])
+    p = Preprocessor()
+    with pytest.raises(PreprocessingError):
+        p.join_panel([w1, w2])
+
+
+def test_join_panel_of_pivoted_waves(df):
+    p = Preprocessor()
+    wave = p.pivot("response", p.keep_final_answer(df[df.surveyid == "a"]))
+    other = p.pivot("response", p.keep_final_answer(df[df.surveyid == "c"]))
+    panel = p.join_panel([wave, other], labels=["a", "c"])
+
+    assert panel.userid.tolist() == ["1", "2", "3"]
+    assert panel.a_D.tolist()[0] == "response"
+    assert panel.c_A.isna().tolist() == [True, True, False]
+
+
+def test_stateless_join_panel_takes_frames(waves):
+    p = StatelessPreprocessor()
+    panel = p.join_panel([Frame(w) for w in waves])
+    assert isinstance(panel, Frame)
+    assert panel.df.shape == (4, 4)
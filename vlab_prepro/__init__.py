@@ -1,5 +1,38 @@
 __version__ = "0.5.1"
 
-from .preprocess import PreprocessingError, Preprocessor, compute_seed, parse_number
+from .utils import compute_seed, parse_number
 
-__all__ = ["Preprocessor", "PreprocessingError", "parse_number", "compute_seed"]
+# everything else needs pandas, so it is only imported when first used: a
+# service that just computes seeds shouldn't pay for loading pandas
+_LAZY = {
+    "Preprocessor": ".preprocess",
+    "PreprocessingError": ".preprocess",
+    "PivotConflictError": ".preprocess",
+    "StatelessPreprocessor": ".stateless",
+    "Frame": ".stateless",
+}
+
+__all__ = [
+    "Preprocessor",
+    "StatelessPreprocessor",
+    "Frame",
+    "PreprocessingError",
+    "PivotConflictError",
+    "parse_number",
+    "compute_seed",
+]
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+    from importlib import import_module
+
+    value = getattr(import_module(_LAZY[name], __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,205 @@
+"""Runs a declarative preprocessing pipeline over many studies at once.
+
+The spec (JSON, or YAML if PyYAML is installed) lists the Preprocessor
+steps, with their arguments, and the studies to run them on:
+
+    {
+      "preprocessor": {"respondent_table": false},
+      "pipeline": [
+        "add_form_data",
+        {"step": "add_metadata", "args": [["clusterid"]]},
+        "add_duration",
+        "keep_final_answer",
+        {"step": "pivot", "args": ["translated_response"]}
+      ],
+      "studies": [
+        {"name": "study-a", "responses": "a/responses.csv", "forms": "a/forms.csv"}
+      ]
+    }
+
+add_form_data is given the forms of each study as its first argument. Each
+study is written to <output>/<name>.<format> and a JSON summary line with
+timings and row counts is printed for each.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import pandas as pd
+
+from .preprocess import PreprocessingError, Preprocessor
+
+
+def load_spec(path):
+    path = Path(path)
+    with open(path) as f:
+        if path.suffix in {".yaml", ".yml"}:
+            try:
+                import yaml
+            except ImportError as e:
+                raise PreprocessingError(
+                    "Reading a YAML spec requires PyYAML, use a JSON spec or "
+                    "install it with: pip install pyyaml"
+                ) from e
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def _parse_step(step):
+    if isinstance(step, str):
+        return step, [], {}
+    return step["step"], step.get("args", []), step.get("kwargs", {})
+
+
+def validate_spec(spec):
+    for key in ["pipeline", "studies"]:
+        if key not in spec:
+            raise PreprocessingError(f"Spec is missing the {key} section.")
+
+    p = Preprocessor(**spec.get("preprocessor", {}))
+    for step in spec["pipeline"]:
+        name, _, _ = _parse_step(step)
+        if name.startswith("_") or not callable(getattr(p, name, None)):
+            raise PreprocessingError(f"Unknown preprocessing step: {name}")
+
+    names = [study["name"] for study in spec["studies"]]
+    if len(set(names)) != len(names):
+        raise PreprocessingError("Study names in the spec must be unique.")
+
+
+def read_frame(path):
+    path = Path(path)
+    if path.suffix == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+
+def write_frame(df, path):
+    if path.suffix == ".parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+
+
+def run_study(spec, study, output, fmt="csv"):
+    """Runs the pipeline of the spec on one study, returning its summary."""
+
+    summary = {"study": study["name"], "status": "ok", "steps": []}
+    start = time.perf_counter()
+
+    try:
+        df = read_frame(study["responses"])
+        forms = read_frame(study["forms"]) if "forms" in study else None
+        summary["input_rows"] = df.shape[0]
+
+        p = Preprocessor(**spec.get("preprocessor", {}))
+        for step in spec["pipeline"]:
+            name, args, kwargs = _parse_step(step)
+            if name == "add_form_data":
+                if forms is None:
+                    raise PreprocessingError(
+                        f"Study {study['name']} has no forms for add_form_data."
+                    )
+                args = [forms, *args]
+
+            step_start = time.perf_counter()
+            fn = getattr(p, name)
+            df = fn(*args, **kwargs)(df) if args or kwargs else fn(df)
+            summary["steps"].append(
+                {
+                    "step": name,
+                    "seconds": round(time.perf_counter() - step_start, 3),
+                    "rows": getattr(df, "shape", [None])[0],
+                }
+            )
+
+        if isinstance(df, pd.DataFrame):
+            out = Path(output) / f"{study['name']}.{fmt}"
+            out.parent.mkdir(parents=True, exist_ok=True)
+            write_frame(df, out)
+            summary["output"] = str(out)
+            summary["output_rows"] = df.shape[0]
+
+    except (Exception, PreprocessingError) as e:
+        logging.exception(f"Study {study['name']} failed.")
+        summary["status"] = "failed"
+        summary["error"] = f"{type(e).__name__}: {e}"
+
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def _limit_memory(max_memory_mb):
+    # caps the address space of each worker, so a study that is too
+    # large fails with a MemoryError instead of taking the machine down
+    if max_memory_mb is None:
+        return
+
+    try:
+        import resource
+    except ImportError:
+        logging.warning("Memory cap is not supported on this platform.")
+        return
+
+    limit = max_memory_mb * 1024 * 1024
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def run(spec, output, workers=1, max_memory_mb=None, fmt="csv"):
+    """Runs all the studies of the spec in a pool of worker processes,
+    yielding the summary of each study as it finishes."""
+
+    validate_spec(spec)
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=_limit_memory, initargs=(max_memory_mb,)
+    ) as pool:
+        futures = [
+            pool.submit(run_study, spec, study, output, fmt)
+            for study in spec["studies"]
+        ]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="vlab-prepro",
+        description="Run a preprocessing pipeline spec over many studies.",
+    )
+    parser.add_argument("spec", help="pipeline spec (JSON or YAML)")
+    parser.add_argument("output", help="directory to write the studies to")
+    parser.add_argument(
+        "--workers", type=int, default=1, help="number of studies run at once"
+    )
+    parser.add_argument(
+        "--max-memory",
+        type=int,
+        default=None,
+        help="memory cap of each worker, in MB",
+    )
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    args = parser.parse_args(argv)
+
+    try:
+        spec = load_spec(args.spec)
+        summaries = run(
+            spec, args.output, args.workers, args.max_memory, args.format
+        )
+        failed = 0
+        for summary in summaries:
+            print(json.dumps(summary, default=str), flush=True)
+            failed += summary["status"] != "ok"
+    except PreprocessingError as e:
+        parser.exit(2, f"vlab-prepro: error: {e}\n")
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,16 +2,32 @@ import hashlib
 import json
 import logging
 import re
+from functools import reduce
+from pathlib import Path
+from urllib.parse import quote
 
 import farmhash
+import numpy as np
 import pandas as pd
 from toolz import curry
 
+from .sketch import AnswerTimes, QuantileSketch
+from .utils import compute_seed, hash_int, parse_number  # noqa: F401
+
 
 class PreprocessingError(BaseException):
     pass
 
 
+class PivotConflictError(PreprocessingError):
+    """Raised when rows would collide in the pivot. The report holds one
+    line per group and question that was answered more than once."""
+
+    def __init__(self, message, report):
+        super().__init__(message)
+        self.report = report
+
+
 def wrap_empty(fn):
     def _wrapper(df, *args, **kwargs):
         if df.shape[0] == 0:
@@ -21,17 +37,18 @@ def wrap_empty(fn):
     return _wrapper
 
 
-def _flatten_dict(col, r, prefix):
-    for k, v in json.loads(r[col]).items():
-        if prefix is None:
-            r[k] = v
-        else:
-            r[f"{prefix}_{k}"] = v
-    return r
+def flatten_dict(col, df, prefix=None):
+    # decodes all the json at once, into one (typed) column per key
+    flat = pd.DataFrame([json.loads(x) for x in df[col]], index=df.index)
+    if prefix is not None:
+        flat = flat.add_prefix(f"{prefix}_")
 
+    # keys in the json take precedence over existing columns
+    existing = [c for c in flat.columns if c in df.columns]
+    for c in existing:
+        flat[c] = flat[c].combine_first(df[c])
 
-def flatten_dict(col, df, prefix=None):
-    return df.apply(lambda r: _flatten_dict(col, r, prefix), 1).drop(columns=[col])
+    return pd.concat([df.drop(columns=[col, *existing]), flat], axis=1)
 
 
 def _new_cols(left, right):
@@ -39,31 +56,240 @@ def _new_cols(left, right):
     return {k for k in right.columns if k not in left}
 
 
-def _add_duration(df):
-    df = df.sort_values("timestamp")
-    df["survey_start_time"] = df.timestamp.iloc[0]
-    df["survey_end_time"] = df.timestamp.iloc[-1]
-    df["survey_duration"] = (
-        df.timestamp.iloc[-1] - df.timestamp.iloc[0]
-    ).total_seconds()
+DURATION_KEYS = [
+    "survey_start_time",
+    "survey_end_time",
+    "survey_duration",
+    "answer_time_min",
+    "answer_time_median",
+    "answer_time_75",
+    "answer_time_90",
+]
 
-    time_to_answer = df.timestamp.diff().dt.total_seconds()
-    df["answer_time_min"] = time_to_answer.min()
-    df["answer_time_median"] = time_to_answer.quantile(0.5)
-    df["answer_time_75"] = time_to_answer.quantile(0.75)
-    df["answer_time_90"] = time_to_answer.quantile(0.90)
+INVALID_KEYS = ["invalid_answer_percentage", "invalid_answer_count"]
 
-    return df
+RESPONDENT_FEATURES = ["final_answer", "duration", "invalid"]
+
+# keys computed from a chunk of responses, which can differ between chunks
+# of the same respondent
+DERIVED_KEYS = DURATION_KEYS + INVALID_KEYS + ["week", "month"]
+
+# integer column identifying the unique combination of keys of each row,
+# only used within pivot
+GROUP_ID = "__vlab_group_id"
+
+
+def _codes(s):
+    return pd.factorize(s, use_na_sentinel=False)[0].astype(np.int64)
+
+
+def _combine_codes(left, right):
+    # both are codes < n, so the product fits comfortably in an int64
+    if len(right) == 0:
+        return left
+    return _codes(left * (right.max() + 1) + right)
+
+
+def _group_ids(df, keys):
+    codes = np.zeros(df.shape[0], dtype=np.int64)
+    for key in sorted(keys):
+        codes = _combine_codes(codes, _codes(df[key]))
+    return codes
+
+
+def _is_grouped(df, groups):
+    """Checks, in linear time, that each group is contiguous and ordered by
+    timestamp. Group codes are in order of first appearance, so the groups
+    are contiguous exactly when the codes never decrease."""
+    if np.any(groups[1:] < groups[:-1]):
+        return False
+    same_group = groups[1:] == groups[:-1]
+    backwards = (df.timestamp.diff() < pd.Timedelta(0)).to_numpy()[1:]
+    return not np.any(backwards & same_group)
+
+
+def _sort_by_group(df, group_ids, presorted=False):
+    """Sorts df by group, and by timestamp within each group. Returns the
+    sorted df and the (dense) group code of each row.
+
+    If presorted, the df is expected to already be in that order and is
+    only verified, falling back to the sort if the verification fails.
+    """
+    groups = _codes(group_ids)
+
+    if presorted and _is_grouped(df, groups):
+        return df, groups
+
+    order = (
+        pd.DataFrame({"group": groups, "timestamp": df.timestamp.to_numpy()})
+        .sort_values(["group", "timestamp"], kind="stable")
+        .index.to_numpy()
+    )
+    return df.take(order).reset_index(drop=True), groups[order]
+
+
+def _duration_stats(df, groups):
+    # df must be sorted by timestamp within each group. Returns one
+    # line per group, indexed by the group code.
+    grouped = df.timestamp.groupby(groups)
+    start = grouped.min()
+    end = grouped.max()
+
+    time_to_answer = grouped.diff().dt.total_seconds()
+    stats = time_to_answer.groupby(groups)
+    quantiles = stats.quantile([0.5, 0.75, 0.90]).unstack()
+
+    return pd.DataFrame(
+        {
+            "survey_start_time": start,
+            "survey_end_time": end,
+            "survey_duration": (end - start).dt.total_seconds(),
+            "answer_time_min": stats.min(),
+            "answer_time_median": quantiles[0.5],
+            "answer_time_75": quantiles[0.75],
+            "answer_time_90": quantiles[0.90],
+        }
+    )
+
+
+def _answer_times(df, groups, relative_accuracy):
+    # df must be sorted by timestamp within each group. Returns the
+    # AnswerTimes of each group, indexed by the group code.
+    grouped = df.timestamp.groupby(groups)
+    starts = grouped.min()
+    ends = grouped.max()
+
+    gaps = grouped.diff().dt.total_seconds().to_numpy()
+    answered = ~np.isnan(gaps)
+    gaps, answer_groups = gaps[answered], groups[answered]
+
+    # all the gaps are bucketed at once, then counted per group
+    positive = gaps > 0
+    keys = np.zeros(gaps.shape[0], dtype=np.int64)
+    keys[positive] = QuantileSketch(relative_accuracy).bucket_keys(gaps[positive])
+
+    gaps = pd.DataFrame(
+        {"group": answer_groups, "key": keys, "zero": ~positive, "gap": gaps}
+    )
+    summary = (
+        gaps.groupby("group")
+        .agg(
+            zeros=("zero", "sum"),
+            count=("gap", "size"),
+            lo=("gap", "min"),
+            hi=("gap", "max"),
+        )
+        .reindex(starts.index)
+    )
+
+    # bucket counts sorted by group, split into the buckets of each group
+    buckets = gaps[~gaps.zero].groupby(["group", "key"]).size()
+    bucket_groups = buckets.index.get_level_values("group").to_numpy()
+    bounds = np.searchsorted(bucket_groups, starts.index.to_numpy(), side="left")
+    bounds = np.append(bounds, len(bucket_groups)).tolist()
+    bucket_keys = buckets.index.get_level_values("key").tolist()
+    bucket_counts = buckets.tolist()
+
+    states = []
+    rows = zip(
+        starts.tolist(),
+        ends.tolist(),
+        summary["zeros"].fillna(0).astype(np.int64).tolist(),
+        summary["count"].fillna(0).astype(np.int64).tolist(),
+        summary["lo"].tolist(),
+        summary["hi"].tolist(),
+    )
+    for i, (start, end, zeros, count, lo, hi) in enumerate(rows):
+        sketch = QuantileSketch(relative_accuracy)
+        if count:
+            b, e = bounds[i], bounds[i + 1]
+            counts = dict(zip(bucket_keys[b:e], bucket_counts[b:e]))
+            sketch.add_counts(counts, zeros, count, lo, hi)
+        states.append(AnswerTimes(sketch, start, end))
+
+    return pd.Series(states, index=starts.index, dtype=object)
+
+
+def _answer_time_stats(answer_times):
+    starts = pd.to_datetime(answer_times.map(lambda a: a.start))
+    ends = pd.to_datetime(answer_times.map(lambda a: a.end))
+    sketches = answer_times.map(lambda a: a.sketch)
+
+    return pd.DataFrame(
+        {
+            "survey_start_time": starts,
+            "survey_end_time": ends,
+            "survey_duration": (ends - starts).dt.total_seconds(),
+            "answer_time_min": sketches.map(lambda s: s.min).astype(float),
+            "answer_time_median": sketches.map(lambda s: s.quantile(0.5)),
+            "answer_time_75": sketches.map(lambda s: s.quantile(0.75)),
+            "answer_time_90": sketches.map(lambda s: s.quantile(0.90)),
+        }
+    )
+
+
+def merge_answer_times(*tables, on=None):
+    """Merges the answer_times tables of add_duration (run with a
+    relative_accuracy) over different chunks of the responses, such as
+    different days, into one line per respondent (identified by the on
+    columns, by default all but answer_times). The tables can be given in
+    any order, but the chunks should not overlap in time."""
+    table = pd.concat(tables, ignore_index=True)
+    keys = list(table.columns.drop("answer_times") if on is None else on)
+    table = table[[*keys, "answer_times"]]
+
+    # chunks are merged in order of time, so each gap between consecutive
+    # chunks is counted
+    merged = table.groupby(keys, dropna=False, sort=False).answer_times.agg(
+        lambda a: reduce(AnswerTimes.merge, sorted(a, key=lambda t: t.start))
+    )
+    return merged.reset_index()
+
+
+def answer_time_stats(table):
+    """Computes the duration features of add_duration from a table of
+    answer times, i.e. after merging in a new chunk of responses."""
+    stats = _answer_time_stats(table.answer_times).reset_index(drop=True)
+    keys = table.drop(columns="answer_times").reset_index(drop=True)
+    return pd.concat([keys, stats], axis=1)
+
+
+def _broadcast(df, stats, groups):
+    return df.assign(**{c: stats[c].array.take(groups) for c in stats.columns})
+
+
+def _final_answer(df, cols=("userid", "surveyid", "question_ref")):
+    # The final answer is the one with the latest timestamp, ties going
+    # to the row that comes last in the frame. Hash-based, no sort needed.
+    cols = list(cols)
+    latest = df.groupby(cols, dropna=False).timestamp.transform("max")
+    flags = (df.timestamp == latest).to_numpy()
+    candidates = np.flatnonzero(flags)
+    earlier = df.iloc[candidates].duplicated(cols, keep="last").to_numpy()
+    flags[candidates[earlier]] = False
+    return flags
+
+
+def _count_invalid(df):
+    invalid = (~df.final_answer).groupby(df.userid)
+    return df.assign(
+        invalid_answer_percentage=invalid.transform("mean"),
+        invalid_answer_count=invalid.transform("sum"),
+    )
+
+
+def _invalid_stats(df):
+    invalid = (~df.final_answer).groupby(df.userid)
+    return pd.DataFrame(
+        {
+            "invalid_answer_percentage": invalid.mean(),
+            "invalid_answer_count": invalid.sum(),
+        }
+    ).reset_index()
 
 
 def add_final_answer(df):
-    df = df.sort_values("timestamp")
-    df["final_answer"] = True
-    df.loc[
-        df.duplicated(["userid", "surveyid", "question_ref"], keep="last"),
-        "final_answer",
-    ] = False
-    return df
+    return df.assign(final_answer=_final_answer(df))
 
 
 @curry
@@ -87,6 +313,236 @@ def _add_time_indicators(indicators, df):
     return df
 
 
+def _hash_values(values, salt=None):
+    # hashes each unique value once, stable across runs and machines
+    codes, uniques = pd.factorize(values, use_na_sentinel=False)
+    prefix = "" if salt is None else f"{salt}_"
+    hashes = [farmhash.fingerprint64(f"{prefix}{u}") for u in uniques]
+    return np.array(hashes, dtype=np.uint64)[codes]
+
+
+def _row_hashes(df, columns):
+    # 64 bit fingerprint of each row over the columns, combining the
+    # hashes of each column in order (as in boost::hash_combine)
+    hashes = np.zeros(df.shape[0], dtype=np.uint64)
+    for col in columns:
+        h = _hash_values(df[col])
+        hashes ^= (
+            h
+            + np.uint64(0x9E3779B97F4A7C15)
+            + (hashes << np.uint64(6))
+            + (hashes >> np.uint64(2))
+        )
+    return hashes
+
+
+def _kept_within_tolerance(times, candidates, tolerance):
+    # times are sorted within each fingerprint, candidates are the events
+    # within the tolerance of the event before them. Each is compared to the
+    # last event that was kept, which only needs a loop over the candidates
+    keep = ~candidates
+    last = None
+    for i in np.flatnonzero(candidates):
+        if not candidates[i - 1]:
+            last = times[i - 1]
+        if times[i] - last > tolerance:
+            keep[i] = True
+            last = times[i]
+    return keep
+
+
+def dedupe_events(columns, tolerance, df):
+    hashes = _row_hashes(df, columns)
+    events = pd.DataFrame({"hash": hashes, "timestamp": df.timestamp.array})
+
+    if tolerance is None:
+        return df[~events.duplicated().to_numpy()]
+
+    # an event is a duplicate if it came within the tolerance of the last
+    # kept event with the same fingerprint
+    events = events.sort_values(["hash", "timestamp"], kind="stable")
+    same = events.hash.eq(events.hash.shift())
+    close = events.timestamp.diff() <= tolerance
+    times = events.timestamp.to_numpy(dtype="datetime64[ns]").view(np.int64)
+    keep = _kept_within_tolerance(times, (same & close).to_numpy(), tolerance.value)
+
+    kept = np.zeros(df.shape[0], dtype=bool)
+    kept[events.index.to_numpy()] = keep
+    return df[kept]
+
+
+def _user_buckets(userid, buckets):
+    hashes = _hash_values(userid)
+    return pd.Series(hashes % np.uint64(buckets), index=userid.index)
+
+
+def sample_users(fraction, seed, by, df):
+    hashes = _hash_values(df.userid, seed)
+
+    if not by:
+        # each user is kept on their own, so the sample is stable as
+        # users are added to the data
+        keep = hashes / 2.0**64 < fraction
+        return df[keep]
+
+    # within each stratum, keep the users with the lowest hashes
+    pairs = df[list(by) + ["userid"]].assign(hash=hashes / 2.0**64)
+    pairs = pairs.drop_duplicates(list(by) + ["userid"])
+    strata = pairs.groupby(list(by), dropna=False).hash
+    rank = strata.rank(method="first")
+    size = strata.transform("size")
+    sampled = pairs.userid[rank <= np.ceil(fraction * size)]
+    return df[df.userid.isin(sampled)]
+
+
+def _as_times_of(times, like):
+    # converts times to the same timezone (or lack of) as like
+    times = pd.to_datetime(times)
+    tz = like.dt.tz
+    if tz is None:
+        return times.dt.tz_convert(None) if times.dt.tz is not None else times
+    if times.dt.tz is None:
+        return times.dt.tz_localize(tz)
+    return times.dt.tz_convert(tz)
+
+
+def assign_waves(wave_table, name, times):
+    """Labels each of the times with the wave whose [start, end) window it
+    falls in, using a binary search over the sorted wave starts. Only the
+    last wave can be open ended, with a missing end."""
+
+    if wave_table.shape[0] == 0:
+        raise PreprocessingError("The wave table has no waves.")
+
+    waves = wave_table.sort_values("start").reset_index(drop=True)
+    starts = _as_times_of(waves.start, times)
+    ends = _as_times_of(waves.end, times)
+
+    previous_ends = ends.iloc[:-1].to_numpy()
+    overlap = starts.iloc[1:].to_numpy() < previous_ends
+    if overlap.any() or pd.isna(previous_ends).any():
+        raise PreprocessingError(
+            "Waves in the wave table should not overlap, and only the last "
+            "one can be missing an end."
+        )
+
+    idx = starts.array.searchsorted(times.array, side="right") - 1
+    end = ends.array.take(idx.clip(0))
+    inside = (idx >= 0) & times.notna().to_numpy()
+    inside &= pd.isna(end) | (times.array < end)
+
+    # keeps the type of the wave ids, with integer ids made nullable only
+    # if some times fall outside of every wave
+    ids = waves[name].array
+    if inside.all():
+        return ids.take(idx)
+    if pd.api.types.is_integer_dtype(ids.dtype):
+        ids = ids.astype("Int64")
+    return ids.take(np.where(inside, idx, -1), allow_fill=True)
+
+
+def _last_question(df, by):
+    """One line per respondent (userid and surveyid), with their by columns
+    and the last (highest) question_idx they reached."""
+    respondents = _combine_codes(_codes(df.userid), _codes(df.surveyid))
+
+    # codes are in order of first appearance, as are the groups of max
+    first_rows = pd.Series(respondents).drop_duplicates().index
+    last = df.question_idx.groupby(respondents, sort=False).max()
+
+    cols = list(dict.fromkeys(["userid", "surveyid", *by]))
+    table = df[cols].iloc[first_rows].reset_index(drop=True)
+    return table.assign(question_idx=last.to_numpy())
+
+
+def completion_funnel(by, respondents, questions):
+    """Counts, for every question_idx of each survey, the respondents of
+    each stratum (the by columns) whose last question it was and, with a
+    reverse cumulative sum, the respondents that reached it."""
+    strata = list(dict.fromkeys([*by, "surveyid"]))
+
+    dropped = respondents.groupby(strata + ["question_idx"], dropna=False).size()
+
+    grid = (
+        respondents[strata]
+        .drop_duplicates()
+        .merge(questions.drop_duplicates(), on="surveyid")
+        .sort_values(strata + ["question_idx"], kind="stable")
+        .reset_index(drop=True)
+    )
+    dropped = dropped.rename("dropped_off").reset_index()
+    funnel = grid.merge(dropped, on=strata + ["question_idx"], how="left")
+    funnel["dropped_off"] = funnel.dropped_off.fillna(0).astype(np.int64)
+
+    by_stratum = funnel.groupby(strata, dropna=False, sort=False).dropped_off
+    started = by_stratum.transform("sum")
+    funnel["reached"] = started - by_stratum.cumsum() + funnel.dropped_off
+    funnel["reached_rate"] = funnel.reached / started
+    return funnel
+
+
+def _unify_parquet_files(paths):
+    """Rewrites the files whose schema differs from the union of the schemas
+    of all of them, adding missing columns and promoting types (i.e. a
+    question that is all null in one partition), one file at a time. Readers
+    of a directory of Parquet files take the schema of the first file."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schemas = [pq.read_schema(path) for path in paths]
+    unified = pa.unify_schemas(schemas, promote_options="permissive")
+
+    for path, schema in zip(paths, schemas):
+        if schema.equals(unified):
+            continue
+
+        table = pq.read_table(path)
+        for field in unified:
+            if field.name not in table.column_names:
+                nulls = pa.nulls(table.num_rows, field.type)
+                table = table.append_column(field.name, nulls)
+        table = table.select(unified.names).cast(unified)
+        pq.write_table(table, path)
+
+
+def _label_columns(columns, on, label, suffix):
+    if suffix:
+        return [c if c == on else f"{c}_{label}" for c in columns]
+    return [c if c == on else f"{label}_{c}" for c in columns]
+
+
+def join_panel(frames, labels, on, how, suffix):
+    """Joins wide frames with one line per `on` into a panel. The ids of
+    all the frames are factorized together once, into a shared (sorted)
+    integer index, and each frame is aligned to it by position, rather than
+    merging the frames on their (string) ids one after the other."""
+
+    codes, ids = pd.factorize(
+        pd.concat([f[on] for f in frames], ignore_index=True), sort=True
+    )
+    bounds = np.cumsum([0] + [f.shape[0] for f in frames])
+
+    present = np.zeros(len(ids), dtype=np.int64)
+    aligned = []
+    for f, label, start, end in zip(frames, labels, bounds[:-1], bounds[1:]):
+        positions = np.full(len(ids), -1, dtype=np.int64)
+        positions[codes[start:end]] = np.arange(end - start)
+        present += positions >= 0
+
+        values = f.drop(columns=on)
+        values.columns = _label_columns(values.columns, on, label, suffix)
+        aligned.append(values.reset_index(drop=True).reindex(positions))
+
+    panel = pd.concat(
+        [pd.DataFrame({on: ids})] + [a.reset_index(drop=True) for a in aligned],
+        axis=1,
+    )
+    panel.columns.name = "question_ref"
+    if how == "inner":
+        panel = panel[present == len(frames)].reset_index(drop=True)
+    return panel
+
+
 def drop_duplicated_users(form_keys, df):
     # form_keys should uniquely identify your form
     # (i.e. shortcode! Or, if there are multiple shortcodes that shouldn't
@@ -105,89 +561,130 @@ def drop_duplicated_users(form_keys, df):
     return df[~df.userid.isin(duplicated_users)]
 
 
-def parse_number(s):
-    """Follows similar validation rules to the chatbot number validator
-
-    Note: these rules are pretty loose and maybe result in silly numbers.
+class Preprocessor:
+    def __init__(self, respondent_table=False):
+        self.keys = {"userid"}
+        self.form_df = None
 
-    """
-    try:
-        s = re.sub(",", "", s)
-        s = re.sub(r"\.", "", s)
-        s = s.strip()
-        return int(s)
-    except TypeError:
-        return s
-    except ValueError:
-        return None
-
-
-def hash_int(i):
-    b = str(i).encode("ASCII")
-    h = hashlib.sha256()
-    h.update(b)
-    return h.hexdigest()
-
-
-def compute_seed(seed: int, n: int = None, m: int = 0, *, key: str = None) -> int:
-    """Compute seed value matching the survey system's seed_N_M format.
-
-    This replicates the JavaScript implementation used in the survey chatbot,
-    allowing researchers to calculate treatment arms and randomization groups
-    from the base seed in their exported data.
-
-    Can be called with either explicit n/m parameters or a key string.
-
-    Args:
-        seed: Base seed from survey data export (32-bit integer)
-        n: Range for the result (returns value from 1 to n inclusive)
-        m: Number of rehashes for distinct seeds (default 0).
-           Use different m values to get independent random values
-           from the same base seed.
-        key: Alternative to n/m - a string in format "seed_N" or "seed_N_M"
-             (e.g., "seed_3", "seed_5_2")
-
-    Returns:
-        Integer from 1 to n (inclusive)
-
-    Examples:
-        >>> compute_seed(2960024492, 2)  # coin flip
-        1
-        >>> compute_seed(2960024492, 3)  # 3-arm trial
-        3
-        >>> compute_seed(2960024492, 2, m=1)  # second coin flip
-        1
-        >>> compute_seed(2960024492, key="seed_3")  # using key format
-        3
-        >>> compute_seed(2960024492, key="seed_2_1")  # key with rehash
-        1
-    """
-    if key is not None:
-        match = re.match(r"seed_(\d+)(?:_(\d+))?$", key)
-        if not match:
-            raise ValueError(f"Invalid key format: {key}. Expected 'seed_N' or 'seed_N_M'")
-        n = int(match.group(1))
-        m = int(match.group(2)) if match.group(2) else 0
-    elif n is None:
-        raise ValueError("Must provide either 'n' or 'key' parameter")
+        # With respondent_table, per-respondent features (durations, invalid
+        # counts, time indicators) are kept in self.respondents, one line
+        # per respondent, rather than repeated on every response. They are
+        # joined to the output of pivot.
+        self.respondent_table = respondent_table
+        self.respondents = None
+        self.respondent_keys = set()
+
+        # with add_duration(relative_accuracy=...), the mergeable answer
+        # times of each respondent (see vlab_prepro.sketch)
+        self.answer_times = None
+
+        # keys that the last frame produced is known to be grouped by,
+        # ordered by timestamp within each group. Lets steps verify the
+        # order in linear time rather than sorting again.
+        self.grouped_by = None
+
+    def _group_id(self, df):
+        # computed afresh for every frame, as frames can come from other
+        # Preprocessors or be concatenated chunks
+        return _group_ids(df, self.keys)
+
+    def _with_group_id(self, df):
+        # a shallow copy, so the (possibly large) frame is not copied
+        df = df.copy(deep=False)
+        df[GROUP_ID] = self._group_id(df)
+        return df
 
-    for _ in range(m):
-        seed = farmhash.fingerprint32(str(seed))
+    def _replace_keys(self, cols):
+        # a step is about to replace the columns of keys in cols, so the
+        # frame may no longer be grouped by them
+        if set(cols) & self.keys:
+            self.grouped_by = None
 
-    return (seed % n) + 1
+    def _add_respondents(self, table, keys):
+        if self.respondents is None:
+            self.respondents = table
+        else:
+            on = sorted(self.respondent_keys & set(keys))
+            features = [c for c in table.columns if c not in keys]
+            self.respondents = self.respondents.drop(
+                columns=features, errors="ignore"
+            ).merge(table, on=on, how="outer")
+
+        self.respondent_keys = self.respondent_keys | set(keys)
+
+    def _group_respondents(self, df, groups, stats, keys=None):
+        # groups are numbered in order of appearance, as are the first rows
+        keys = sorted(self.keys if keys is None else keys)
+        first_rows = pd.Series(groups).drop_duplicates().index
+        table = df[keys].iloc[first_rows].reset_index(drop=True)
+        return pd.concat([table, stats.reset_index(drop=True)], axis=1)
+
+    def _join_respondents(self, groups):
+        on = sorted(self.respondent_keys & set(groups.columns))
+        if self.respondents.duplicated(on).any():
+            raise PreprocessingError(
+                "Could not join the respondent table. It has more than one "
+                f"line per {on}, did you remove_form_data after computing "
+                "respondent features?"
+            )
 
+        features = [c for c in self.respondents.columns if c not in groups.columns]
+        return (
+            groups.reset_index()
+            .merge(self.respondents[on + features], on=on, how="left")
+            .set_index(GROUP_ID)
+        )
 
-class Preprocessor:
-    def __init__(self):
-        self.keys = {"userid"}
-        self.form_df = None
+    def _sort_by_group(self, df):
+        presorted = self.grouped_by is not None and self.grouped_by <= self.keys
+        df, groups = _sort_by_group(df, self._group_id(df), presorted)
+        self.grouped_by = set(self.keys)
+        return df, groups
 
     @curry
     def add_form_data(self, form_df, df, prefix=None):
         new_form_df = flatten_dict("metadata", form_df, prefix)
+        if new_form_df.surveyid.duplicated().any():
+            raise PreprocessingError(
+                "Form data should have one line per surveyid, "
+                "found duplicated surveyids."
+            )
+        overlap = sorted(set(new_form_df.columns) & set(df.columns) - {"surveyid"})
+        if overlap:
+            raise PreprocessingError(
+                "Form data has columns that are already in the responses: "
+                f"{overlap}. Rename or drop them before adding the form data."
+            )
         self.form_df = new_form_df
+
+        # the form data is looked up by the position of the survey of each
+        # response in the (small) form table, rather than merged in, so that
+        # the responses are not copied
+        rows = pd.Index(new_form_df.surveyid).get_indexer(df.surveyid)
+        missing = (rows < 0).sum()
+        if missing and missing == df.shape[0]:
+            raise PreprocessingError(
+                "None of the responses have a surveyid in the form data. Are "
+                "the surveyids of the same type (responses: "
+                f"{df.surveyid.dtype}, forms: {new_form_df.surveyid.dtype})?"
+            )
+        if missing:
+            logging.warning(
+                f"Removing {missing} responses to surveys without form data."
+            )
+            df, rows = df[rows >= 0], rows[rows >= 0]
+        else:
+            df = df.copy(deep=False)
+        df.index = pd.RangeIndex(df.shape[0])
+
+        form = new_form_df.drop(columns="surveyid")
+        form = pd.DataFrame(
+            {c: form[c].array.take(rows) for c in form.columns}, index=df.index
+        )
+        df = pd.concat([df, form], axis=1, copy=False)
+
         self.keys = self.keys | set(new_form_df.columns)
-        return df.merge(new_form_df, on="surveyid")
+        return df
 
     @curry
     def remove_form_data(self, df):
@@ -202,11 +699,13 @@ class Preprocessor:
     @curry
     def add_metadata(self, keys, df):
         question_refs = set(df.question_ref.unique())
+        cols = {}
         for key in keys:
             col_name = f"{key}_metadata" if key in question_refs else key
-            df[col_name] = df.metadata.map(lambda x: json.loads(x).get(key))
-            self.keys.add(col_name)
-        return df
+            cols[col_name] = df.metadata.map(lambda x: json.loads(x).get(key))
+        self._replace_keys(cols)
+        self.keys = self.keys | set(cols)
+        return df.assign(**cols)
 
     @curry
     def parse_timestamp(self, df):
@@ -215,26 +714,53 @@ class Preprocessor:
         return df.assign(timestamp=df.timestamp.map(lambda x: pd.Timestamp(x)))
 
     @curry
-    def add_duration(self, df):
+    def add_duration(self, df, relative_accuracy=None):
+        """Adds the start, end and duration of each survey and quantiles of
+        the time taken between answers.
+
+        With a relative_accuracy, the quantiles are computed from sketches
+        that are within that relative error of the exact values. The
+        sketches are kept, one per respondent, in self.answer_times and can
+        be serialized and merged with those of later chunks of responses
+        (see merge_answer_times and answer_time_stats).
+        """
         if not pd.api.types.is_datetime64_dtype(df.timestamp):
             df = self.parse_timestamp(df)
 
-        df = (
-            df.groupby(list(self.keys), dropna=False)
-            .apply(_add_duration)
-            .reset_index(drop=True)
-        )
+        df, groups = self._sort_by_group(df)
+        return self._add_duration(df, groups, relative_accuracy)
 
-        self.keys = self.keys | {
-            "survey_start_time",
-            "survey_end_time",
-            "survey_duration",
-            "answer_time_min",
-            "answer_time_median",
-            "answer_time_75",
-            "answer_time_90",
-        }
+    def _add_duration(self, df, groups, relative_accuracy=None):
+        if relative_accuracy is None:
+            stats = _duration_stats(df, groups)
+        else:
+            answer_times = _answer_times(df, groups, relative_accuracy)
+            stats = _answer_time_stats(answer_times)
+            # only the keys that identify the respondent, so that the
+            # answer times of different chunks can be merged
+            self.answer_times = self._group_respondents(
+                df,
+                groups,
+                answer_times.to_frame("answer_times"),
+                self.keys - set(DERIVED_KEYS),
+            )
+
+        if self.respondent_table:
+            table = self._group_respondents(df, groups, stats)
+            self._add_respondents(table, self.keys)
+            return df
+
+        df = _broadcast(df, stats, groups)
+        self.keys = self.keys | set(DURATION_KEYS)
+        return df
+
+    def _count_invalid(self, df):
+        if self.respondent_table:
+            self._add_respondents(_invalid_stats(df), {"userid"})
+            return df
 
+        df = _count_invalid(df)
+        self.keys = self.keys | set(INVALID_KEYS)
         return df
 
     @curry
@@ -249,11 +775,106 @@ class Preprocessor:
 
         inds = [lookup[i] for i in indicators]
 
-        for i in indicators:
-            self.keys.add(i)
+        if self.respondent_table and "survey_start_time" not in df.columns:
+            if self.respondents is None:
+                raise PreprocessingError(
+                    "No survey_start_time in the respondent table. "
+                    "Maybe consider running add_duration first?"
+                )
+            self.respondents = _add_time_indicators(inds, self.respondents)
+            return df
+
+        self._replace_keys(indicators)
+        self.keys = self.keys | set(indicators)
+
+        # resampling reorders the rows by time
+        self.grouped_by = None
 
         return _add_time_indicators(inds, df)
 
+    @curry
+    def add_waves(self, wave_table, df, name="wave"):
+        """Adds the study wave of each respondent's survey, based on the
+        survey_start_time falling within the start and end of the wave.
+
+        The wave_table has the wave id (in a column called name) and the
+        start and end of each wave, the end of the last wave can be missing
+        to leave it open ended. The wave is added to the keys.
+        """
+
+        self._replace_keys([name])
+
+        if self.respondent_table and "survey_start_time" not in df.columns:
+            if self.respondents is None:
+                raise PreprocessingError(
+                    "No survey_start_time in the respondent table. "
+                    "Maybe consider running add_duration first?"
+                )
+            times = self.respondents.survey_start_time
+            waves = assign_waves(wave_table, name, times)
+            self.respondents = self.respondents.assign(**{name: waves})
+
+            on = sorted((self.respondent_keys & set(df.columns)) - {name})
+            if self.respondents.duplicated(on).any():
+                raise PreprocessingError(
+                    "Could not add waves from the respondent table. It has "
+                    f"more than one line per {on}."
+                )
+            df = df.drop(columns=name, errors="ignore").merge(
+                self.respondents[on + [name]], on=on, how="left"
+            )
+
+        elif "survey_start_time" in df.columns:
+            times = df.survey_start_time
+            df = df.assign(**{name: assign_waves(wave_table, name, times)})
+
+        else:
+            raise PreprocessingError(
+                "Dataframe does not have column survey_start_time. "
+                "Maybe consider running add_duration first?"
+            )
+
+        logging.warning(
+            f"{df[name].isna().sum()} responses started outside of any wave."
+        )
+
+        self.keys = self.keys | {name}
+
+        return df
+
+    @curry
+    def add_question_timing(self, df, speeding_threshold=0.3):
+        """Adds, for each answer, the time taken to answer it (the seconds
+        since the previous answer of that user in that survey), the median
+        of that time for the question across respondents and a flag for
+        answers faster than speeding_threshold times that median.
+
+        These are per answer, not per respondent, so they are not added
+        to the keys, but can be pivoted like the answers themselves.
+        """
+
+        if not pd.api.types.is_datetime64_dtype(df.timestamp):
+            df = self.parse_timestamp(df)
+
+        respondent = {"userid", "surveyid"}
+        surveys = _combine_codes(_codes(df.userid), _codes(df.surveyid))
+        presorted = self.grouped_by is not None and respondent <= self.grouped_by
+        sorted_df, groups = _sort_by_group(df, surveys, presorted)
+        if sorted_df is not df:
+            self.grouped_by = respondent
+
+        df = sorted_df
+        question_time = df.timestamp.groupby(groups).diff().dt.total_seconds()
+        median = question_time.groupby(
+            [df.surveyid, df.question_ref], dropna=False
+        ).transform("median")
+
+        return df.assign(
+            question_time=question_time,
+            question_time_median=median,
+            question_speeding=(question_time < speeding_threshold * median),
+        )
+
     @curry
     def add_final_answer(self, df):
         return add_final_answer(df)
@@ -270,23 +891,62 @@ class Preprocessor:
         if "final_answer" not in df.columns:
             df = self.add_final_answer(df)
 
-        df = (
-            df.groupby("userid")
-            .apply(
-                lambda df: df.assign(
-                    invalid_answer_percentage=(~df.final_answer).mean(),
-                    invalid_answer_count=df.final_answer.count()
-                    - df.final_answer.sum(),
-                )
+        return self._count_invalid(df)
+
+    @curry
+    def add_respondent_features(self, features, df, relative_accuracy=None):
+        """Computes any of the final_answer, duration and invalid features
+        in a single pass over the data, sorting it only once. Equivalent to
+        running add_final_answer, add_duration and count_invalid."""
+
+        unknown = set(features) - set(RESPONDENT_FEATURES)
+        if unknown:
+            raise PreprocessingError(
+                f"Unknown respondent features: {sorted(unknown)}. "
+                f"Expected any of {RESPONDENT_FEATURES}"
             )
-            .reset_index(drop=True)
-        )
 
-        self.keys.add("invalid_answer_percentage")
-        self.keys.add("invalid_answer_count")
+        if not pd.api.types.is_datetime64_dtype(df.timestamp):
+            df = self.parse_timestamp(df)
+
+        df, groups = self._sort_by_group(df)
+
+        wants_final = "final_answer" in features or "invalid" in features
+        if wants_final and "final_answer" not in df.columns:
+            df = df.assign(final_answer=_final_answer(df))
+
+        if "duration" in features:
+            df = self._add_duration(df, groups, relative_accuracy)
+
+        if "invalid" in features:
+            df = self._count_invalid(df)
 
         return df
 
+    @curry
+    def completion_funnel(self, df, group_by=None):
+        """Builds the drop-off funnel of each survey: for every question_idx,
+        the number of respondents whose last question it was (dropped_off),
+        the number that reached it (reached) and the share of those that
+        started the survey that reached it (reached_rate).
+
+        The funnels can be split by any of the keys, i.e. group_by=["stratumid"]
+        after add_metadata(["stratumid"]).
+        """
+
+        group_by = list(group_by or [])
+        unknown = [k for k in group_by if k not in self.keys]
+        if unknown:
+            raise PreprocessingError(
+                f"Cannot group the funnel by {unknown}, they are not keys. "
+                "Maybe consider running add_form_data or add_metadata first?"
+            )
+
+        df = df[df.question_idx.notna()]
+        respondents = _last_question(df, group_by)
+        questions = df[["surveyid", "question_idx"]]
+        return completion_funnel(group_by, respondents, questions)
+
     @curry
     def drop_users_without(self, metadata_key, df):
         """Used to drop testers"""
@@ -307,12 +967,79 @@ class Preprocessor:
 
         return df
 
+    @curry
+    def sample_users(self, fraction, df, seed=0, by=None):
+        """Keeps a deterministic sample of users (with all of their rows),
+        chosen by hashing the userid with the seed. The same seed always
+        picks the same users.
+
+        If by is given (i.e. ["surveyid"] or metadata keys), the fraction of
+        users is sampled within each combination of those columns, keeping
+        at least one user from each of them.
+        """
+
+        if not 0 < fraction <= 1:
+            raise ValueError(f"Fraction must be in (0, 1], got: {fraction}")
+
+        missing = [b for b in by or [] if b not in df.columns]
+        if missing:
+            raise PreprocessingError(
+                f"Dataframe does not have columns {missing} to sample by."
+                " Maybe consider running add_form_data or add_metadata first?"
+            )
+
+        users = df.userid.nunique()
+        df = sample_users(fraction, seed, by, df).reset_index(drop=True)
+
+        logging.warning(f"Sampled {df.userid.nunique()} of {users} users.")
+
+        return df
+
+    @curry
+    def dedupe_events(self, df, columns=None, tolerance=None):
+        """Drops duplicated events, such as the rows created by chatbot
+        retries or webhooks delivered twice.
+
+        Rows are fingerprinted with a 64 bit hash of the columns (all but
+        the timestamp, by default). Rows with the same fingerprint are
+        duplicates if they have the same timestamp or, given a tolerance
+        (i.e. "5s" or a number of seconds), if they came within the
+        tolerance of the last event that was kept. With a tolerance of 5s,
+        events at 0s, 4s and 8s keep those at 0s and 8s.
+        """
+
+        if columns is None:
+            columns = [c for c in df.columns if c != "timestamp"]
+
+        if isinstance(tolerance, (int, float)):
+            tolerance = pd.Timedelta(seconds=tolerance)
+        elif tolerance is not None:
+            tolerance = pd.Timedelta(tolerance)
+
+        if tolerance is not None:
+            if not pd.api.types.is_datetime64_dtype(df.timestamp):
+                df = self.parse_timestamp(df)
+
+        deduped = dedupe_events(columns, tolerance, df).reset_index(drop=True)
+
+        removed = df.shape[0] - deduped.shape[0]
+        logging.warning(f"Removing {removed} duplicated events.")
+
+        return deduped
+
     @curry
     def drop_duplicated_users(self, form_keys, df):
         return drop_duplicated_users(form_keys, df)
 
     @curry
-    def pivot(self, answer_column, df):
+    def pivot(self, answer_column, df, on_conflict="raise"):
+        """Pivots to one line per user (and survey, if form data was added)
+        with a column per question.
+
+        Rows that would collide in the pivot are found beforehand. With
+        on_conflict="raise" they raise a PivotConflictError with a report
+        of the conflicts, with on_conflict="final" the final answer is kept.
+        """
         keys = self.keys
 
         if "surveyid" not in keys:
@@ -322,11 +1049,69 @@ class Preprocessor:
                 "as all surveys will be collapsed"
             )
 
+        df = self._resolve_conflicts(self._with_group_id(df), on_conflict)
+        return self._pivot(answer_column, df)
+
+    def _conflicts(self, df):
+        # a single duplicated check on one integer per (group, question)
+        codes = _combine_codes(df[GROUP_ID].to_numpy(), _codes(df.question_ref))
+        return pd.Series(codes, index=df.index).duplicated(keep=False)
+
+    def _conflict_report(self, df, conflicts):
+        cols = [c for c in ["userid", "surveyid", "shortcode"] if c in df.columns]
+        return (
+            df[conflicts]
+            .groupby([GROUP_ID, "question_ref"], dropna=False)
+            .agg(
+                **{c: (c, "first") for c in cols},
+                answers=("question_ref", "size"),
+                first_timestamp=("timestamp", "min"),
+                last_timestamp=("timestamp", "max"),
+            )
+            .reset_index()
+            .sort_values(["userid", "question_ref"])
+            .drop(columns=GROUP_ID)
+            .reset_index(drop=True)
+        )
+
+    @curry
+    def pivot_conflicts(self, df):
+        """Reports the users/surveys that answered a question more than
+        once, which would make pivot fail, with one line per question."""
+        df = self._with_group_id(df)
+        return self._conflict_report(df, self._conflicts(df))
+
+    def _resolve_conflicts(self, df, on_conflict):
+        if on_conflict not in {"raise", "final"}:
+            raise ValueError(f"on_conflict must be raise or final, got: {on_conflict}")
+
+        conflicts = self._conflicts(df)
+        if not conflicts.any():
+            return df
+
+        if on_conflict == "final":
+            final = _final_answer(df, [GROUP_ID, "question_ref"])
+            logging.warning(
+                f"Removing {(~final).sum()} answers to duplicated questions,"
+                " keeping the final answer."
+            )
+            return df[final]
+
+        report = self._conflict_report(df, conflicts)
+        raise PivotConflictError(
+            f"Could not pivot, {report.userid.nunique()} users answered "
+            f"{report.shape[0]} questions more than once (see the report "
+            "attribute of this error). Potentially you should use add_form_data "
+            "to add surveyid and ensure that each user/survey is a unique line "
+            "or remove duplicated questions or duplicated users\n"
+            f"{report.head(10).to_string()}",
+            report,
+        )
+
+    def _pivot(self, answer_column, df):
         try:
-            return (
-                df.pivot(index=keys, columns="question_ref", values=answer_column)
-                .reset_index()
-                .sort_values(["userid"])
+            pivoted = df.pivot(
+                index=GROUP_ID, columns="question_ref", values=answer_column
             )
         except ValueError as e:
             raise PreprocessingError(
@@ -335,10 +1120,122 @@ class Preprocessor:
                 "or remove duplicated questions or duplicated users"
             ) from e
 
+        # key columns are only reattached once, to the pivoted groups
+        index = ["userid"] + sorted(k for k in self.keys if k != "userid")
+        groups = df.drop_duplicates(GROUP_ID).set_index(GROUP_ID)[index]
+        if self.respondents is not None:
+            groups = self._join_respondents(groups)
+        if not groups.userid.is_monotonic_increasing:
+            groups = groups.sort_values(["userid"], kind="stable")
+
+        pivoted = pd.concat([groups, pivoted.reindex(groups.index)], axis=1)
+        pivoted.columns.name = "question_ref"
+        return pivoted.reset_index(drop=True)
+
+    @curry
+    def pivot_to_parquet(
+        self,
+        answer_column,
+        path,
+        df,
+        partition_by="surveyid",
+        buckets=None,
+        on_conflict="raise",
+    ):
+        """Pivots one partition at a time, writing each to its own Parquet
+        file under path (path/<partition>=<value>/part-0.parquet), so the
+        full wide table is never held in memory. The files all share one
+        schema, with every question column, and the partition column is only
+        in the paths, so the whole directory reads back with pd.read_parquet.
+
+        Partitions by the partition_by key or, if buckets is given, by a
+        hash of the userid into that many buckets. Returns the paths written.
+        """
+
+        if buckets is not None:
+            partition_by = "user_bucket"
+        elif partition_by not in self.keys:
+            raise PreprocessingError(
+                f"Cannot partition by {partition_by}, it is not one of the keys. "
+                "Potentially you should use add_form_data to add surveyid "
+                "and shortcode."
+            )
+
+        # conflicts are checked up front, before any partition is written
+        df = self._resolve_conflicts(self._with_group_id(df), on_conflict)
+
+        if buckets is not None:
+            partitions = _user_buckets(df.userid, buckets)
+        else:
+            partitions = df[partition_by]
+
+        paths = []
+
+        for value, idx in partitions.groupby(partitions, dropna=False).indices.items():
+            pivoted = self._pivot(answer_column, df.take(idx))
+
+            # as in the hive layout, the partition value is only in the path
+            pivoted = pivoted.drop(columns=partition_by, errors="ignore")
+            if pd.isna(value):
+                value = "__HIVE_DEFAULT_PARTITION__"
+            else:
+                value = quote(str(value), safe="")
+            out = Path(path) / f"{partition_by}={value}" / "part-0.parquet"
+            out.parent.mkdir(parents=True, exist_ok=True)
+            pivoted.to_parquet(out, index=False)
+            paths.append(out)
+
+        _unify_parquet_files(paths)
+        return paths
+
+    def join_panel(self, frames, labels=None, on="userid", how="outer", suffix=False):
+        """Joins the pivoted frames of several waves (or surveys) into one
+        panel, with a line per user. The columns of each frame are labelled
+        with a prefix (or, with suffix=True, a suffix) of its label, which
+        default to w1, w2, etc. With how="inner", only users that are in
+        every frame are kept.
+        """
+
+        if how not in {"outer", "inner"}:
+            raise ValueError(f"how must be outer or inner, got: {how}")
+
+        if labels is None:
+            labels = [f"w{i}" for i in range(1, len(frames) + 1)]
+        labels = [str(label) for label in labels]
+        if len(labels) != len(frames) or len(set(labels)) != len(labels):
+            raise ValueError("There should be one unique label per frame.")
+
+        for label, f in zip(labels, frames):
+            if on not in f.columns:
+                raise PreprocessingError(f"Frame {label} does not have column {on}.")
+            if f[on].isna().any():
+                raise PreprocessingError(f"Frame {label} has missing values of {on}.")
+            if f[on].duplicated().any():
+                raise PreprocessingError(
+                    f"Frame {label} has more than one line per {on}, it should "
+                    "be pivoted (with one survey per frame) before joining."
+                )
+
+        return join_panel(frames, labels, on, how, suffix)
+
     @curry
     def map_columns(self, cols, fn, df):
+        if set(cols) & (self.keys | {"timestamp"}):
+            self.grouped_by = None
+        if self.respondents is not None and set(cols) & self.respondent_keys:
+            self.respondents = self.respondents.assign(
+                **{
+                    col: self.respondents[col].map(fn)
+                    for col in cols
+                    if col in self.respondent_keys
+                }
+            )
         return df.assign(**{col: df[col].map(fn) for col in cols})
 
     @curry
     def hash_userid(self, df):
+        if self.respondents is not None:
+            self.respondents = self.respondents.assign(
+                userid=self.respondents.userid.map(hash_int)
+            )
         return df.assign(userid=df.userid.map(hash_int))
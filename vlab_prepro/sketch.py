@@ -0,0 +1,175 @@
+"""Mergeable quantile sketches of answer times.
+
+The exact answer time quantiles of add_duration need every timestamp of a
+respondent. A QuantileSketch instead keeps counts of values in logarithmic
+buckets (as in DDSketch), so that every quantile is within a relative error
+of the exact one, and two sketches merge by adding their counts. Sketches of
+different chunks of data, or different days, can then be combined without
+going back to the raw responses.
+"""
+
+import math
+from datetime import datetime
+
+import numpy as np
+
+
+class QuantileSketch:
+    """Quantiles of positive values, within relative_accuracy."""
+
+    def __init__(self, relative_accuracy=0.01):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError(
+                f"relative_accuracy must be in (0, 1), got: {relative_accuracy}"
+            )
+
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.counts = {}
+        self.zero_count = 0
+        self.count = 0
+        self.min = math.nan
+        self.max = math.nan
+
+    def bucket_keys(self, values):
+        return np.ceil(np.log(values) / math.log(self.gamma)).astype(np.int64)
+
+    def add_counts(self, counts, zero_count, count, lo, hi):
+        """Adds already bucketed values (keyed as by bucket_keys), along with
+        the number of zeros, the total count and the min/max of the values."""
+        for key, n in counts.items():
+            self.counts[key] = self.counts.get(key, 0) + n
+        self.zero_count += zero_count
+        self.count += count
+        self.min = float(np.fmin(self.min, lo))
+        self.max = float(np.fmax(self.max, hi))
+        return self
+
+    def add(self, values):
+        values = np.asarray(values, dtype=float)
+        values = values[~np.isnan(values)]
+        if values.shape[0] == 0:
+            return self
+
+        positive = values[values > 0]
+        keys, counts = np.unique(self.bucket_keys(positive), return_counts=True)
+        return self.add_counts(
+            dict(zip(keys.tolist(), counts.tolist())),
+            int((values <= 0).sum()),
+            values.shape[0],
+            float(values.min()),
+            float(values.max()),
+        )
+
+    def merge(self, other):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracies.")
+
+        merged = QuantileSketch(self.relative_accuracy)
+        merged.add_counts(
+            self.counts, self.zero_count, self.count, self.min, self.max
+        )
+        return merged.add_counts(
+            other.counts, other.zero_count, other.count, other.min, other.max
+        )
+
+    def _order_statistic(self, k):
+        # estimate of the k-th smallest value, the extremes are known exactly
+        if k <= 0:
+            return self.min
+        if k >= self.count - 1:
+            return self.max
+
+        seen = self.zero_count
+        if k < seen:
+            return 0.0
+
+        for key in sorted(self.counts):
+            seen += self.counts[key]
+            if k < seen:
+                value = 2 * self.gamma**key / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+
+        return self.max
+
+    def quantile(self, q):
+        """Interpolates linearly between the closest ranks, as pandas and
+        numpy do by default."""
+        if self.count == 0:
+            return math.nan
+
+        rank = min(max(q, 0), 1) * (self.count - 1)
+        lo, hi = math.floor(rank), math.ceil(rank)
+        lower = self._order_statistic(lo)
+        if hi == lo:
+            return lower
+        return lower + (self._order_statistic(hi) - lower) * (rank - lo)
+
+    def to_dict(self):
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "counts": {str(k): n for k, n in self.counts.items()},
+            "zero_count": self.zero_count,
+            "count": self.count,
+            "min": None if math.isnan(self.min) else self.min,
+            "max": None if math.isnan(self.max) else self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d["relative_accuracy"])
+        return sketch.add_counts(
+            {int(k): n for k, n in d["counts"].items()},
+            d["zero_count"],
+            d["count"],
+            math.nan if d["min"] is None else d["min"],
+            math.nan if d["max"] is None else d["max"],
+        )
+
+
+class AnswerTimes:
+    """The answer times of one respondent: a sketch of the seconds between
+    their answers, along with the time of their first and last answer.
+
+    Merging the answer times of two chunks of the respondent's answers also
+    counts the gap between the end of one chunk and the start of the next.
+    If the chunks overlap in time, that gap is unknown and is left out, so
+    the chunks should not overlap and more than two should be merged in
+    order of time (as merge_answer_times does).
+    """
+
+    def __init__(self, sketch, start, end):
+        self.sketch = sketch
+        self.start = start
+        self.end = end
+
+    def merge(self, other):
+        first, second = sorted([self, other], key=lambda a: a.start)
+        sketch = first.sketch.merge(second.sketch)
+
+        gap = (second.start - first.end).total_seconds()
+        if gap >= 0:
+            sketch.add([gap])
+
+        return AnswerTimes(sketch, first.start, max(first.end, second.end))
+
+    def to_dict(self):
+        return {
+            "sketch": self.sketch.to_dict(),
+            "start": self.start.isoformat(),
+            "end": self.end.isoformat(),
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(
+            QuantileSketch.from_dict(d["sketch"]),
+            datetime.fromisoformat(d["start"]),
+            datetime.fromisoformat(d["end"]),
+        )
+
+    def __repr__(self):
+        return (
+            f"AnswerTimes(start={self.start}, end={self.end}, "
+            f"answers={self.sketch.count + 1})"
+        )
@@ -0,0 +1,103 @@
+"""Stateless preprocessing, for running many pipelines at once.
+
+A Preprocessor keeps the keys, form data etc. of the pipeline it is running
+on itself, so one instance can only run one pipeline at a time. Here that
+state travels with the data instead, in a Frame, and every step runs on a
+fresh Preprocessor built from the state of the Frame it is given:
+
+    p = StatelessPreprocessor()
+
+    result = pipe(
+        Frame(responses),
+        p.add_form_data(forms),
+        p.add_metadata(["clusterid"]),
+        p.keep_final_answer,
+        p.pivot("translated_response"),
+    )
+
+    result.df, result.keys
+
+Steps never modify the Frame they are given, so the same
+StatelessPreprocessor can be used from many threads at once.
+"""
+
+import inspect
+
+import pandas as pd
+
+from .preprocess import Preprocessor
+
+
+class Frame:
+    """A dataframe along with the state of the pipeline that produced it."""
+
+    def __init__(self, df, state=None):
+        self.df = df
+        self.state = dict(state or {})
+
+    @property
+    def keys(self):
+        return set(self.state.get("keys", {"userid"}))
+
+    def __repr__(self):
+        return f"Frame(keys={sorted(self.keys)}, df=\n{self.df!r})"
+
+
+def _copy_state(state):
+    # sets are mutable, frames are only ever replaced by the steps
+    return {k: set(v) if isinstance(v, set) else v for k, v in state.items()}
+
+
+def _is_given_dataframe(name, args):
+    # whether a plain DataFrame was passed in place of the step's df
+    params = list(inspect.signature(getattr(Preprocessor, name)).parameters)
+    if "df" not in params or len(args) < params.index("df"):
+        return False
+    return isinstance(args[params.index("df") - 1], pd.DataFrame)
+
+
+class _Step:
+    def __init__(self, options, name):
+        self.options = options
+        self.name = name
+
+    def __call__(self, *args, **kwargs):
+        if _is_given_dataframe(self.name, args):
+            raise TypeError(
+                f"Stateless step {self.name} takes a Frame, not a DataFrame. "
+                "Wrap the dataframe in a Frame first: Frame(df)."
+            )
+
+        if not args or not isinstance(args[-1], Frame):
+            return lambda frame: self(*args, frame, **kwargs)
+
+        *args, frame = args
+        p = Preprocessor(**self.options)
+        vars(p).update(_copy_state(frame.state))
+
+        result = getattr(p, self.name)(*args, frame.df, **kwargs)
+        if not isinstance(result, pd.DataFrame):
+            return result
+        return Frame(result, _copy_state(vars(p)))
+
+    def __repr__(self):
+        return f"<stateless step {self.name}>"
+
+
+class StatelessPreprocessor:
+    """Has the same steps as Preprocessor, taking and returning Frames."""
+
+    def __init__(self, **options):
+        self.options = options
+
+    def __getattr__(self, name):
+        if name.startswith("_") or not callable(getattr(Preprocessor, name, None)):
+            raise AttributeError(name)
+        return _Step(self.options, name)
+
+    def join_panel(self, frames, *args, **kwargs):
+        """Joins the Frames (or dataframes) of several waves into one panel
+        Frame, see Preprocessor.join_panel."""
+        dfs = [f.df if isinstance(f, Frame) else f for f in frames]
+        panel = Preprocessor(**self.options).join_panel(dfs, *args, **kwargs)
+        return Frame(panel)